@@ -1,155 +1,301 @@
-from fastapi import FastAPI, Request, Query
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
-from fastapi.middleware.gzip import GZipMiddleware
-import sqlite3
-from datetime import datetime
+from starlette.concurrency import run_in_threadpool
+import base64
+import hashlib
 import json
-import random
+from contextlib import asynccontextmanager
+from database import Database
+from instrumentation import RequestMetricsMiddleware, phase, request_metrics
+from static_files import CachedStaticFiles, CompressedBody, CompressionMiddleware, asset_url, etag_matches
+from map_clusters import query_clusters
+from facets import hour_bound, query_facets
+from search import search_photos, highlight
+from catalog import PhotoCatalog, PHOTO_COLUMNS, parse_taken_at, parse_json, to_json_photo
 
-app = FastAPI()
+# Loaded once at startup and reloaded only when photos.db changes
+catalog = PhotoCatalog()
 
-# Mount the static files directory
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Pooled read-only connections for the queries that don't go through the catalog
+db = Database()
+
+@asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(catalog.get)
+    yield
+    db.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Static files with content-hash ETags; hashed derivative names are cached as immutable
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
 # Set up templates directory
 templates = Jinja2Templates(directory="templates")
+templates.env.globals['asset_url'] = asset_url
 
-# Add compression middleware
-app.add_middleware(GZipMiddleware, minimum_size=1000)
-
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.strftime('%Y-%m-%d %H:%M:%S')
-        return super().default(obj)
-
-def serialize_photos(photos):
-    """Convert photos to JSON-serializable format"""
-    return json.loads(json.dumps(photos, cls=DateTimeEncoder))
-
-# Database connection function
-def get_db_connection():
-    conn = sqlite3.connect('photos.db')
-    
-    def dict_factory(cursor, row):
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            value = row[idx]
-            if col[0] == 'date_taken' and value:
-                try:
-                    d[col[0]] = datetime.strptime(value, '%Y:%m:%d %H:%M:%S')
-                except ValueError:
-                    d[col[0]] = None
-            else:
-                d[col[0]] = value
-        return d
-    
-    conn.row_factory = dict_factory
-    return conn
-
-# Main page
-@app.get("/", response_class=HTMLResponse)
-async def read_root(request: Request, sort_by: str = Query('date-asc'), location: str = Query(None)):
-    conn = get_db_connection()
-    
-    # First get all photos with their basic info
-    query = '''
-        SELECT p.*, 
-               GROUP_CONCAT(poi.name || '||' || poi.description, '##') as points_of_interest
-        FROM photo p
-        LEFT JOIN point_of_interest poi ON p.id = poi.photo_id
-    '''
-    
-    filters = []
-    params = []
+# Compress dynamic JSON and HTML; images and precompressed bodies pass through
+app.add_middleware(CompressionMiddleware)
+
+# Latency, response size and time per phase for every route, served on /metrics.
+# Added last so it wraps compression and sees the bytes actually sent.
+app.add_middleware(RequestMetricsMiddleware)
+
+# Where the page loads its data from; export_site.py points it at static JSON files instead
+LIVE_SITE = {'catalog': ['/api/catalog'], 'clusters': '/api/clusters', 'search': '/api/search',
+             'facets': '/api/facets'}
+
+# Pages don't depend on the request, so each is rendered and compressed once
+_pages = {}
+
+def render_page(name):
+    if name not in _pages:
+        with phase('render'):
+            body = templates.get_template(name).render(site=LIVE_SITE).encode()
+        _pages[name] = CompressedBody(body, "text/html; charset=utf-8")
+    return _pages[name]
+
+# The compressed catalog of the current snapshot: (snapshot, CompressedBody)
+_compressed_catalog = (None, None)
 
+def compressed_catalog():
+    global _compressed_catalog
+    with phase('catalog'):
+        snapshot = catalog.get()
+    if _compressed_catalog[0] is not snapshot:
+        with phase('serialize'):
+            body, etag = snapshot.catalog_json
+        # Rebuilt after every ingest, so favour compression speed over the last few percent
+        _compressed_catalog = (snapshot, CompressedBody(body, "application/json", etag, best=False))
+    return _compressed_catalog[1]
+
+def photo_srcset(photo, fmt='webp'):
+    """srcset of the non-square derivatives, e.g. '/static/photos/a.thumb.3f2a9c01b7de.webp 640w, ...'"""
+    derivatives = photo.get('derivatives') or {}
+    entries = [
+        f"/static/photos/{d[fmt]} {d['width']}w"
+        for name, d in derivatives.items()
+        if name != 'marker' and d.get(fmt)
+    ]
+    return ', '.join(sorted(entries, key=lambda entry: int(entry.rsplit(' ', 1)[1][:-1])))
+
+# Sort orders for /api/photos: the keyset column and its direction. NULLs sort
+# last, after every non-NULL value, and are paged through by id.
+PAGE_ORDERS = {
+    'date-asc': ('taken_at', 'ASC'),
+    'date-desc': ('taken_at', 'DESC'),
+    'location': ('location_name', 'ASC'),
+}
+
+def encode_cursor(sort_by, value, photo_id):
+    """Opaque cursor for the page after the row with this sort value and id"""
+    return base64.urlsafe_b64encode(json.dumps([sort_by, value, photo_id]).encode()).decode()
+
+def decode_cursor(cursor, sort_by):
+    try:
+        cursor_sort, value, photo_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_sort != sort_by:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort_by")
+    # Every PAGE_ORDERS column is TEXT; anything else can't have come from encode_cursor
+    if not (value is None or isinstance(value, str)) or not isinstance(photo_id, int) or isinstance(photo_id, bool):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, photo_id
+
+def fetch_photo_page(conn, sort_by, location, cursor, per_page):
+    """One page of photos after `cursor`, plus the cursor for the next page.
+
+    Each page is an index range scan from the last row of the previous one, so
+    deep pages cost the same as the first.
+    """
+    column, direction = PAGE_ORDERS[sort_by]
+    compare = '>' if direction == 'ASC' else '<'
+
+    filters, filter_params = [], []
     if location:
-        filters.append('p.location_name LIKE ?')
-        params.append(f'%{location}%')
+        escaped = location.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        filters.append("location_name LIKE ? ESCAPE '\\'")
+        filter_params.append(f'%{escaped}%')
+
+    value, last_id = decode_cursor(cursor, sort_by) if cursor else (None, None)
+    in_null_tail = cursor is not None and value is None
 
-    if filters:
-        query += ' WHERE ' + ' AND '.join(filters)
+    photos = []
+    if not in_null_tail:
+        where = filters + [f'{column} IS NOT NULL']
+        params = list(filter_params)
+        if cursor:
+            where.append(f'({column}, id) {compare} (?, ?)')
+            params += [value, last_id]
+        photos = conn.execute(
+            f'SELECT {PHOTO_COLUMNS} FROM photo WHERE {" AND ".join(where)} '
+            f'ORDER BY {column} {direction}, id {direction} LIMIT ?',
+            params + [per_page + 1]
+        ).fetchall()
+    if len(photos) <= per_page:
+        # Rows without a sort value come last, in id order
+        where = filters + [f'{column} IS NULL']
+        params = list(filter_params)
+        if in_null_tail:
+            where.append('id > ?')
+            params.append(last_id)
+        photos += conn.execute(
+            f'SELECT {PHOTO_COLUMNS} FROM photo WHERE {" AND ".join(where)} ORDER BY id LIMIT ?',
+            params + [per_page + 1 - len(photos)]
+        ).fetchall()
 
-    query += ' GROUP BY p.id'  # Group by photo id to combine points of interest
+    next_cursor = None
+    if len(photos) > per_page:
+        photos = photos[:per_page]
+        next_cursor = encode_cursor(sort_by, photos[-1][column], photos[-1]['id'])
+    return photos, next_cursor
 
-    if sort_by == 'date-asc':
-        query += ' ORDER BY p.date_taken ASC NULLS LAST'
-    elif sort_by == 'location':
-        query += ' ORDER BY p.location_name NULLS LAST'
-    else:
-        query += ' ORDER BY p.date_taken DESC NULLS LAST'
+def load_photo_page(conn, sort_by, location, cursor, per_page):
+    photos, next_cursor = fetch_photo_page(conn, sort_by, location, cursor, per_page)
+    attach_points_of_interest(conn, photos)
+    return photos, next_cursor
 
-    photos = conn.execute(query, params).fetchall()
-    
-    # Process the points_of_interest string into a structured format
+def attach_points_of_interest(conn, photos):
+    """Fill in each photo's points of interest with a single query"""
+    by_id = {photo['id']: photo for photo in photos}
     for photo in photos:
-        poi_str = photo.get('points_of_interest')
-        points_of_interest = []
-        if poi_str:
-            for poi in poi_str.split('##'):
-                if '||' in poi:
-                    name, description = poi.split('||')
-                    points_of_interest.append({
-                        'name': name,
-                        'description': description
-                    })
-        photo['points_of_interest'] = points_of_interest
-
-    conn.close()
-
-    # Get unique locations for the filter dropdown
-    unique_locations = list(set(photo['location_name'] for photo in photos if photo['location_name']))
-    
-    # Get 3 random photos for the featured section
-    random_photos = random.sample(photos, min(3, len(photos)))
-    
-    # Serialize photos for JavaScript
-    serialized_photos = serialize_photos(photos)
-    
-    return templates.TemplateResponse(
-        "index.html", 
-        {
-            "request": request, 
-            "photos": photos,
-            "featured_photos": random_photos,
-            "serialized_photos": serialized_photos,
-            "unique_locations": unique_locations
-        }
-    )
+        photo['points_of_interest'] = []
+    if not by_id:
+        return
+    placeholders = ', '.join('?' * len(by_id))
+    for row in conn.execute(
+        f'SELECT photo_id, name, description FROM point_of_interest WHERE photo_id IN ({placeholders}) ORDER BY id',
+        list(by_id)
+    ):
+        by_id[row['photo_id']]['points_of_interest'].append({'name': row['name'], 'description': row['description']})
+
+# Main page: a shell with no photo data, the page fetches /api/catalog itself
+@app.get("/", response_class=HTMLResponse)
+async def read_root(request: Request):
+    page = await run_in_threadpool(render_page, "index.html")
+    return page.response(request)
+
+# Compact catalog for the page, revalidated with ETag so repeat visits get a 304
+@app.get("/api/catalog")
+async def get_catalog(request: Request):
+    # Reloading and compressing after an ingest take a while; keep them off the event loop
+    body = await run_in_threadpool(compressed_catalog)
+    return body.response(request)
 
 # Add API endpoint for lazy loading
 @app.get("/api/photos")
 async def get_photos(
-    page: int = Query(1, ge=1),
     per_page: int = Query(12, ge=1, le=50),
     location: str = None,
-    sort_by: str = None
+    sort_by: str = Query('date-asc'),
+    cursor: str = None
 ):
-    offset = (page - 1) * per_page
-    
-    query = 'SELECT * FROM photo'
-    params = []
-    
-    if location:
-        query += ' WHERE location_name = ?'
-        params.append(location)
-        
-    if sort_by == 'date-asc':
-        query += ' ORDER BY date_taken ASC'
-    elif sort_by == 'date-desc':
-        query += ' ORDER BY date_taken DESC'
-        
-    query += ' LIMIT ? OFFSET ?'
-    params.extend([per_page, offset])
-    
-    conn = get_db_connection()
-    photos = conn.execute(query, params).fetchall()
-    conn.close()
-    
-    return JSONResponse(content={"photos": photos})
+    if sort_by not in PAGE_ORDERS:
+        raise HTTPException(status_code=400, detail=f"sort_by must be one of {', '.join(PAGE_ORDERS)}")
+
+    photos, next_cursor = await db.run(load_photo_page, sort_by, location, cursor, per_page)
+
+    with phase('serialize'):
+        results = []
+        for photo in photos:
+            photo['date_taken'] = parse_taken_at(photo.pop('taken_at'))
+            photo['derivatives'] = parse_json(photo['derivatives'])
+            result = to_json_photo(photo)
+            result['srcset'] = photo_srcset(photo)
+            results.append(result)
+        return JSONResponse(content={"photos": results, "next_cursor": next_cursor})
+
+def photo_url(photo, size, fmt='webp'):
+    """URL of a photo derivative, falling back to the original if it wasn't generated"""
+    derivative = (photo.get('derivatives') or {}).get(size)
+    if derivative and derivative.get(fmt):
+        return '/static/photos/' + derivative[fmt]
+    return '/static/photos/' + photo['file_path']
+
+def etag_response(request, body):
+    """JSON response with a content-hash ETag, or a 304 if the client already has it"""
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# Map markers for the visible area, from the clusters precomputed at ingest
+@app.get("/api/clusters")
+async def get_clusters(request: Request, bbox: str, zoom: int = Query(..., ge=0, le=30)):
+    try:
+        west, south, east, north = (float(value) for value in bbox.split(','))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be west,south,east,north")
+
+    zoom, rows = await db.run(query_clusters, zoom, west, south, east, north)
+    with phase('serialize'):
+        clusters = []
+        for row in rows:
+            cluster = {
+                "count": row["count"],
+                "latitude": row["latitude"],
+                "longitude": row["longitude"],
+                "photo_id": row["photo_id"],
+                "bounds": [[row["min_latitude"], row["min_longitude"]], [row["max_latitude"], row["max_longitude"]]],
+            }
+            if row["file_path"]:
+                cluster["thumbnail"] = photo_url(
+                    {"file_path": row["file_path"], "derivatives": parse_json(row["derivatives"])}, 'marker'
+                )
+            clusters.append(cluster)
+        body = json.dumps({"zoom": zoom, "clusters": clusters}, separators=(',', ':')).encode()
+        return etag_response(request, body)
+
+# Timeline and location counts from the facet table precomputed at ingest
+@app.get("/api/facets")
+async def get_facets(request: Request, location: str = None, start: str = None, end: str = None):
+    try:
+        start = hour_bound(start) if start else None
+        end = hour_bound(end, end=True) if end else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start and end must be ISO dates or date-times")
+
+    result = await db.run(query_facets, location, start, end)
+    with phase('serialize'):
+        body = json.dumps(result, separators=(',', ':')).encode()
+        return etag_response(request, body)
+
+# Full-text search; prefix=true matches the last word as a prefix for search-as-you-type
+@app.get("/api/search")
+async def search(
+    q: str,
+    page: int = Query(1, ge=1),
+    per_page: int = Query(20, ge=1, le=100),
+    prefix: bool = False
+):
+    rows, has_more = await db.run(search_photos, q, per_page, (page - 1) * per_page, prefix)
+    with phase('serialize'):
+        results = []
+        for row in rows:
+            photo = {
+                "id": row["id"],
+                "file_path": row["file_path"],
+                "caption": row["caption"],
+                "location_name": row["location_name"],
+                "date_taken": parse_taken_at(row["taken_at"]),
+                "derivatives": parse_json(row["derivatives"]),
+            }
+            result = to_json_photo(photo)
+            result["thumbnail"] = photo_url(photo, 'thumb')
+            result["snippet"] = highlight(row["snippet"])
+            results.append(result)
+        return JSONResponse(content={"results": results, "page": page, "has_more": has_more})
 
 @app.get("/about", response_class=HTMLResponse)
 async def about(request: Request):
-    return templates.TemplateResponse("about.html", {"request": request}) 
\ No newline at end of file
+    page = await run_in_threadpool(render_page, "about.html")
+    return page.response(request)
+
+# Request metrics of this worker process in the Prometheus text format
+@app.get("/metrics")
+async def metrics():
+    return Response(content=request_metrics.prometheus_text(prefix='photo_app_'),
+                    media_type="text/plain; version=0.0.4")
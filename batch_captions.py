@@ -0,0 +1,194 @@
+import json
+import sqlite3
+import time
+import uuid
+from datetime import datetime, timezone
+from pipeline import DatabaseWriter, exif_json
+from metrics import metrics
+from captioning import (
+    build_caption_request, get_anthropic_client, parse_tool_response,
+    points_of_interest_json, record_usage, CAPTION_TOOL
+)
+
+# API limits are 100,000 requests or 256 MB per batch; stay comfortably under
+MAX_BATCH_REQUESTS = 10000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+# Everything the writer needs to insert the photo once its caption arrives
+RECORD_FIELDS = (
+    'relative_path', 'photographer', 'date_taken', 'latitude', 'longitude',
+    'location_name', 'exif_data', 'derivatives', 'deep_zoom', 'dhash',
+    'content_hash', 'size', 'mtime_ns', 'replaces'
+)
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+def pending_batch_paths(db_path='photos.db'):
+    """Files already submitted in a batch whose results haven't been written yet"""
+    conn = sqlite3.connect(db_path)
+    paths = {row[0] for row in conn.execute(
+        "SELECT relative_path FROM caption_batch_item WHERE status = 'pending'"
+    )}
+    conn.close()
+    return paths
+
+class BatchSubmitter:
+    """Pipeline stage that collects caption requests and submits them as message batches.
+
+    Runs as a single-worker stage: `add` is the stage function and never passes
+    records downstream. Each batch and its items are saved to SQLite as soon as
+    the batch is created, so an interrupted run can pick up the results later.
+    """
+    def __init__(self, db_path='photos.db', max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES,
+                 prompt=None):
+        self.db_path = db_path
+        self.prompt = prompt
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        self.submitted = 0
+
+    def add(self, record, limiter):
+        request = build_caption_request(
+            record.pop('prepared'),
+            record['photographer'],
+            record['map_image_path'],
+            record['location_name'],
+            self.prompt
+        )
+        request['tools'] = [CAPTION_TOOL]
+        request['tool_choice'] = {'type': 'tool', 'name': CAPTION_TOOL['name']}
+        size = len(json.dumps(request))
+
+        if self.pending and (len(self.pending) >= self.max_requests
+                             or self.pending_bytes + size > self.max_bytes):
+            self.flush(limiter)
+
+        stored = {field: record.get(field) for field in RECORD_FIELDS}
+        stored['exif_data'] = exif_json(stored['exif_data'])
+        self.pending.append((uuid.uuid4().hex, request, stored))
+        self.pending_bytes += size
+        return None
+
+    def flush(self, limiter=None):
+        """Submit everything collected so far as one message batch"""
+        if not self.pending:
+            return None
+        if limiter is not None:
+            limiter.wait()
+        print(f"Submitting batch of {len(self.pending)} caption requests "
+              f"({self.pending_bytes / 1024 / 1024:.1f} MB)...")
+        batch = get_anthropic_client().messages.batches.create(requests=[
+            {'custom_id': custom_id, 'params': request}
+            for custom_id, request, _ in self.pending
+        ])
+        metrics.count('api_calls_total', api='anthropic_batch', status='submitted')
+        metrics.count('api_bytes_sent_total', self.pending_bytes, api='anthropic_batch')
+
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.execute(
+                'INSERT INTO caption_batch (batch_id, status, created_at) VALUES (?, ?, ?)',
+                (batch.id, batch.processing_status, _now())
+            )
+            conn.executemany('''
+                INSERT INTO caption_batch_item (custom_id, batch_id, relative_path, record, status)
+                VALUES (?, ?, ?, ?, 'pending')
+            ''', [
+                (custom_id, batch.id, stored['relative_path'], json.dumps(stored))
+                for custom_id, _, stored in self.pending
+            ])
+        conn.close()
+
+        print(f"Submitted batch {batch.id}")
+        self.submitted += len(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        return batch.id
+
+def _write_results(conn, batch_id, db_batch_size, db_path='photos.db'):
+    """Insert the photos of a finished batch and mark its items done or failed"""
+    client = get_anthropic_client()
+    items = {
+        custom_id: json.loads(record)
+        for custom_id, record in conn.execute(
+            "SELECT custom_id, record FROM caption_batch_item WHERE batch_id = ? AND status = 'pending'",
+            (batch_id,)
+        )
+    }
+    # A run interrupted after writing but before marking items done must not insert twice
+    already_written = {row[0] for row in conn.execute('SELECT file_path FROM photo')}
+
+    writer = DatabaseWriter(db_path=db_path, batch_size=db_batch_size)
+    writer.start()
+    statuses = []
+    try:
+        for entry in client.messages.batches.results(batch_id):
+            record = items.get(entry.custom_id)
+            if record is None:
+                continue
+            if entry.result.type != 'succeeded':
+                print(f"Caption request for {record['relative_path']} {entry.result.type}")
+                statuses.append(('failed', entry.custom_id))
+                continue
+            record_usage(entry.result.message.usage, record['relative_path'])
+            try:
+                analysis = parse_tool_response(entry.result.message)
+            except ValueError as e:
+                print(f"Could not parse caption for {record['relative_path']}: {str(e)}")
+                statuses.append(('failed', entry.custom_id))
+                continue
+            if record['relative_path'] not in already_written or record.get('replaces'):
+                record['caption'] = analysis.caption
+                record['points_of_interest'] = points_of_interest_json(analysis)
+                writer.put(record)
+            statuses.append(('done', entry.custom_id))
+    finally:
+        writer.close()
+
+    with conn:
+        conn.executemany('UPDATE caption_batch_item SET status = ? WHERE custom_id = ?', statuses)
+        conn.execute(
+            "UPDATE caption_batch SET status = 'ended', ended_at = ? WHERE batch_id = ?",
+            (_now(), batch_id)
+        )
+    done = sum(1 for status, _ in statuses if status == 'done')
+    print(f"Batch {batch_id}: {done} captions saved, {len(statuses) - done} failed")
+
+def collect_batches(db_path='photos.db', poll_interval=60, db_batch_size=25):
+    """Poll every unfinished batch until it ends and write its results.
+
+    Safe to interrupt: batches stay recorded as unfinished and the next run
+    resumes polling them. Failed items are not written, so their photos are
+    picked up as new on the next run.
+    """
+    conn = sqlite3.connect(db_path)
+    client = get_anthropic_client()
+    try:
+        while True:
+            batch_ids = [row[0] for row in conn.execute(
+                "SELECT batch_id FROM caption_batch WHERE status != 'ended' ORDER BY id"
+            )]
+            if not batch_ids:
+                return
+            for batch_id in batch_ids:
+                batch = client.messages.batches.retrieve(batch_id)
+                if batch.processing_status == 'ended':
+                    _write_results(conn, batch_id, db_batch_size, db_path)
+                    continue
+                counts = batch.request_counts
+                print(f"Batch {batch_id} {batch.processing_status}: "
+                      f"{counts.processing} processing, {counts.succeeded} succeeded, {counts.errored} errored")
+                with conn:
+                    conn.execute('UPDATE caption_batch SET status = ? WHERE batch_id = ?',
+                                 (batch.processing_status, batch_id))
+            remaining = conn.execute(
+                "SELECT COUNT(*) FROM caption_batch WHERE status != 'ended'"
+            ).fetchone()[0]
+            if remaining:
+                print(f"Waiting {poll_interval}s for {remaining} batch(es) to finish...")
+                time.sleep(poll_interval)
+    finally:
+        conn.close()
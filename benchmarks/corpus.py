@@ -0,0 +1,215 @@
+"""Synthetic, reproducible photo corpora for benchmarks.
+
+Two kinds, both generated from a seed so every run and every commit sees the
+same data:
+
+    # JPEGs with GPS and capture-time EXIF, some of them burst shots,
+    # laid out like photos/<photographer>/
+    python benchmarks/corpus.py images photos --count 100
+
+    # photos.db filled directly (captions, points of interest, derivatives,
+    # clusters, facets, search index) at a scale ingest would take days to reach
+    python benchmarks/corpus.py database --count 100000
+
+Run from the directory that holds (or will hold) photos.db.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from fractions import Fraction
+from PIL import Image, ImageChops, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import setup_database  # noqa: E402
+from derivatives import DERIVATIVE_SIZES  # noqa: E402
+from facets import build_facets  # noqa: E402
+from map_clusters import build_clusters, photo_quadkey  # noqa: E402
+from pipeline import exif_json  # noqa: E402
+
+PHOTOGRAPHERS = ('Chuck', 'Ashley', 'Dan', 'Christina')
+
+# (location_name as the geocoder returns it, latitude, longitude, spread in degrees)
+PLACES = (
+    ('Tokyo, Tokyo', 35.6762, 139.6503, 0.08),
+    ('Osaka, Osaka Prefecture', 34.6937, 135.5023, 0.05),
+    ('Kyoto, Kyoto Prefecture', 35.0116, 135.7681, 0.04),
+    ('Nara, Nara Prefecture', 34.6851, 135.8048, 0.02),
+    ('Hakone, Kanagawa Prefecture', 35.2324, 139.1069, 0.03),
+    ('Austin, Texas', 30.2672, -97.7431, 0.05),
+)
+
+POINTS_OF_INTEREST = (
+    ('Senso-ji', "tokyo's oldest temple, founded in 645"),
+    ('Fushimi Inari Taisha', 'shrine famous for thousands of vermilion torii gates'),
+    ('Dotonbori', "osaka's neon-lit canal street, known for street food"),
+    ('Kinkaku-ji', 'zen temple covered in gold leaf'),
+    ('Shibuya Crossing', 'one of the busiest pedestrian crossings in the world'),
+    ('Todai-ji', 'temple housing a 15 m bronze buddha'),
+    ('Arashiyama Bamboo Grove', 'bamboo forest on the western edge of kyoto'),
+    ('Shinkansen', "japan's high-speed bullet train network"),
+    ('Izakaya', 'casual japanese pub serving small plates'),
+    ('Onsen', 'hot spring bath, often volcanic'),
+)
+
+CAPTION_WORDS = (
+    'ramen', 'temple', 'shrine', 'train', 'market', 'street', 'garden', 'river', 'lanterns', 'night',
+    'sushi', 'crowd', 'bridge', 'castle', 'deer', 'view', 'alley', 'coffee', 'rain', 'sunset',
+    'bamboo', 'gate', 'station', 'vending', 'machine', 'hotel', 'breakfast', 'walk', 'bar', 'karaoke',
+)
+
+TRIP_START = datetime(2024, 10, 19, 7, 0, 0)
+TRIP_DAYS = 13
+
+# Share of generated images that repeat the previous shot a second later, like a phone burst
+BURST_FRACTION = 0.15
+
+def _dms(value):
+    """Decimal degrees as EXIF (degrees, minutes, seconds) rationals"""
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = Fraction((value - degrees - minutes / 60) * 3600).limit_denominator(10000)
+    return (Fraction(degrees), Fraction(minutes), seconds)
+
+def synthetic_photo(rng, index):
+    """Metadata of one synthetic photo: where, when, who and what it shows"""
+    location, lat, lon, spread = rng.choice(PLACES)
+    taken = TRIP_START + timedelta(seconds=rng.randrange(TRIP_DAYS * 86400))
+    photographer = PHOTOGRAPHERS[index % len(PHOTOGRAPHERS)]
+    has_gps = rng.random() > 0.05
+    return {
+        'relative_path': f'{photographer}/IMG_{index:06d}.jpg',
+        'photographer': photographer,
+        'latitude': lat + rng.gauss(0, spread) if has_gps else None,
+        'longitude': lon + rng.gauss(0, spread) if has_gps else None,
+        'location_name': location if has_gps else None,
+        'date_taken': taken.strftime('%Y:%m:%d %H:%M:%S') if rng.random() > 0.02 else None,
+        'caption': ' '.join(rng.choice(CAPTION_WORDS) for _ in range(rng.randint(8, 24))),
+        'points_of_interest': rng.sample(POINTS_OF_INTEREST, rng.randint(0, 3)),
+    }
+
+def burst_shot(previous, index):
+    """The next shot of a burst: same place and subject, one second later"""
+    taken = datetime.strptime(previous['date_taken'], '%Y:%m:%d %H:%M:%S') + timedelta(seconds=1)
+    return dict(
+        previous,
+        relative_path=f"{previous['photographer']}/IMG_{index:06d}.jpg",
+        date_taken=taken.strftime('%Y:%m:%d %H:%M:%S'),
+    )
+
+def _scene(rng, size):
+    """A background colour and a few large shapes, so each scene has its own perceptual hash"""
+    width, height = size
+    shapes = []
+    for _ in range(rng.randint(3, 6)):
+        x, y = rng.randrange(width), rng.randrange(height)
+        w, h = rng.randint(width // 8, width // 2), rng.randint(height // 8, height // 2)
+        shapes.append(((x - w, y - h, x + w, y + h), tuple(rng.randrange(256) for _ in range(3))))
+    return tuple(rng.randrange(256) for _ in range(3)), shapes
+
+def _draw_scene(scene, noise, shift):
+    background, shapes = scene
+    image = Image.new('RGB', noise.size, background)
+    draw = ImageDraw.Draw(image)
+    for (left, top, right, bottom), colour in shapes:
+        draw.ellipse((left + shift[0], top + shift[1], right + shift[0], bottom + shift[1]), fill=colour)
+    return Image.blend(image, noise, 0.35)
+
+def write_images(root, count, seed=0, size=(2048, 1536), burst_fraction=BURST_FRACTION):
+    """Write `count` JPEGs under root/<photographer>/ with GPS and DateTimeOriginal EXIF"""
+    rng = random.Random(seed)
+    # Noise keeps the JPEGs about as large and as slow to decode as real photos
+    noise = Image.merge('RGB', [Image.effect_noise(size, 40 + 10 * channel) for channel in range(3)])
+    photo = scene = None
+    for index in range(count):
+        if photo and photo['date_taken'] and rng.random() < burst_fraction:
+            # Same scene, with the camera moved slightly and fresh sensor noise
+            photo = burst_shot(photo, index)
+            shift = (rng.randint(-size[0] // 100, size[0] // 100), rng.randint(-size[1] // 100, size[1] // 100))
+            frame_noise = ImageChops.offset(noise, rng.randrange(size[0]), rng.randrange(size[1]))
+        else:
+            photo = synthetic_photo(rng, index)
+            scene, shift, frame_noise = _scene(rng, size), (0, 0), noise
+        image = _draw_scene(scene, frame_noise, shift)
+        exif = Image.Exif()
+        exif[0x010F] = 'Synthetic'  # Make
+        exif[0x0110] = 'Benchmark Camera'  # Model
+        if photo['date_taken']:
+            exif.get_ifd(0x8769)[0x9003] = photo['date_taken']  # DateTimeOriginal
+        if photo['latitude'] is not None:
+            exif.get_ifd(0x8825).update({
+                1: 'N' if photo['latitude'] >= 0 else 'S',
+                2: _dms(photo['latitude']),
+                3: 'E' if photo['longitude'] >= 0 else 'W',
+                4: _dms(photo['longitude']),
+            })
+        path = os.path.join(root, photo['relative_path'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        image.save(path, format='JPEG', quality=90, exif=exif)
+    print(f"Wrote {count} synthetic photos to {root}/")
+
+def _derivatives(relative_path):
+    stem = os.path.splitext(relative_path)[0]
+    return {
+        name: {'width': edge, 'height': edge * 3 // 4, 'webp': f'{stem}.{name}.{index:012x}.webp'}
+        for index, (name, edge) in enumerate(DERIVATIVE_SIZES.items())
+    }
+
+def fill_database(count, seed=0, batch_size=5000):
+    """Insert `count` synthetic photos into photos.db as if ingest had processed them"""
+    started = time.perf_counter()
+    setup_database.setup_database()
+    rng = random.Random(seed)
+    conn = sqlite3.connect('photos.db')
+    first = conn.execute('SELECT COALESCE(MAX(id), 0) FROM photo').fetchone()[0]
+    for start in range(0, count, batch_size):
+        with conn:
+            for index in range(first + start, first + min(count, start + batch_size)):
+                photo = synthetic_photo(rng, index)
+                exif = {'Make': 'Synthetic', 'Model': 'Benchmark Camera', 'DateTimeOriginal': photo['date_taken']}
+                cursor = conn.execute('''
+                    INSERT INTO photo (
+                        file_path, caption, date_taken, taken_at, latitude, longitude, quadkey,
+                        location_name, exif_data, photographer, derivatives
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    photo['relative_path'], photo['caption'], photo['date_taken'],
+                    datetime.strptime(photo['date_taken'], '%Y:%m:%d %H:%M:%S').isoformat()
+                    if photo['date_taken'] else None,
+                    photo['latitude'], photo['longitude'], photo_quadkey(photo['latitude'], photo['longitude']),
+                    photo['location_name'], exif_json(exif), photo['photographer'],
+                    json.dumps(_derivatives(photo['relative_path'])),
+                ))
+                conn.executemany(
+                    'INSERT INTO point_of_interest (photo_id, name, description) VALUES (?, ?, ?)',
+                    [(cursor.lastrowid, name, description) for name, description in photo['points_of_interest']]
+                )
+    with conn:
+        build_clusters(conn.cursor())
+        build_facets(conn.cursor())
+    conn.execute('PRAGMA optimize')
+    conn.close()
+    elapsed = time.perf_counter() - started
+    print(f"Added {count} synthetic photos to photos.db in {elapsed:.1f}s")
+    return elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('kind', choices=('images', 'database'))
+    parser.add_argument('root', nargs='?', default='photos', help='output directory for images')
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--size', type=int, nargs=2, default=(2048, 1536), metavar=('WIDTH', 'HEIGHT'),
+                        help='pixel size of generated images')
+    args = parser.parse_args()
+    if args.kind == 'images':
+        write_images(args.root, args.count, args.seed, tuple(args.size))
+    else:
+        fill_database(args.count, args.seed)
@@ -0,0 +1,140 @@
+"""Requests per second of the web app under concurrent load, at several uvicorn worker counts.
+
+Starts `uvicorn app:app --workers N` for each N against the photos.db in the
+current directory, hammers it with keep-alive clients for a fixed time and
+reports throughput and latency percentiles:
+
+    python benchmarks/http_load.py --workers 1 2 4 --concurrency 64 \\
+        --path '/api/photos?per_page=24' --path /api/catalog --output results.json
+
+Clients run in separate processes so the load generator isn't limited by one
+GIL; on a small machine they still compete with the server for CPU, so compare
+runs made on the same host.
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/about')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start within {timeout}s")
+
+def client_loop(port, paths, deadline):
+    """One keep-alive client; returns (latencies in ms, error count)"""
+    latencies, errors = [], 0
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    i = 0
+    while time.monotonic() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+    conn.close()
+    return latencies, errors
+
+def client_process(port, paths, clients, deadline):
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda _: client_loop(port, paths, deadline), range(clients)))
+    latencies = [latency for result, _ in results for latency in result]
+    return latencies, sum(errors for _, errors in results)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_load(port, paths, concurrency, duration, processes):
+    # Deadlines are compared with time.monotonic(), which is system-wide on Linux and macOS
+    deadline = time.monotonic() + duration
+    processes = max(1, min(processes, concurrency))
+    shares = [concurrency // processes + (1 if i < concurrency % processes else 0) for i in range(processes)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(client_process, port, paths, clients, deadline) for clients in shares]
+        results = [future.result() for future in futures]
+    latencies = sorted(latency for result, _ in results for latency in result)
+    errors = sum(errors for _, errors in results)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': round(len(latencies) / duration, 1),
+        'latency_ms': {
+            'mean': round(statistics.fmean(latencies), 2) if latencies else None,
+            'p50': round(percentile(latencies, 0.50), 2) if latencies else None,
+            'p95': round(percentile(latencies, 0.95), 2) if latencies else None,
+            'p99': round(percentile(latencies, 0.99), 2) if latencies else None,
+        },
+    }
+
+def benchmark(workers, args):
+    command = [
+        sys.executable, '-m', 'uvicorn', 'app:app',
+        '--host', '127.0.0.1', '--port', str(args.port),
+        '--workers', str(workers), '--log-level', 'warning', '--no-access-log',
+    ]
+    server = subprocess.Popen(command)
+    try:
+        wait_until_up(args.port)
+        # Warm the catalog and page caches in every worker before measuring
+        run_load(args.port, args.path, args.concurrency, min(2.0, args.duration), args.client_processes)
+        result = run_load(args.port, args.path, args.concurrency, args.duration, args.client_processes)
+    finally:
+        server.terminate()
+        server.wait()
+    result.update(workers=workers, concurrency=args.concurrency, duration=args.duration, paths=args.path)
+    return result
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='uvicorn worker counts to compare')
+    parser.add_argument('--concurrency', type=int, default=32, help='simultaneous keep-alive clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load per worker count')
+    parser.add_argument('--path', action='append', help='request path, repeatable (default: /api/photos)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--client-processes', type=int, default=os.cpu_count() or 1,
+                        help='processes the clients are spread over')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args(argv)
+    args.path = args.path or ['/api/photos?per_page=24']
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = []
+    for workers in args.workers:
+        print(f"Benchmarking {workers} worker(s), {args.concurrency} clients for {args.duration}s...")
+        result = benchmark(workers, args)
+        latency = result['latency_ms']
+        print(f"  {result['requests_per_second']} req/s, p50 {latency['p50']} ms, "
+              f"p99 {latency['p99']} ms, {result['errors']} errors")
+        results.append(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.output}")
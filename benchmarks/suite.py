@@ -0,0 +1,283 @@
+"""Benchmark suite: ingest throughput and API latency at several catalog sizes.
+
+    python benchmarks/suite.py --output results/$(git rev-parse --short HEAD).json
+    python benchmarks/suite.py --scales 100 10000 --compare results/baseline.json
+
+Everything runs in a scratch directory against a synthetic corpus
+(benchmarks/corpus.py), so results only depend on the code and the machine:
+
+- ingest: process_images.py on --ingest-photos generated JPEGs, with
+  Nominatim, SerpAPI and Anthropic replaced by stub_servers.py
+- serving: for each --scales size, photos.db is filled with that many
+  synthetic photos and `uvicorn app:app` is loaded with keep-alive clients;
+  each path reports requests/s, latency percentiles and payload size with and
+  without compression
+
+--compare prints the change from an earlier results file and, with
+--fail-on-regression, exits with status 1 if anything got worse than
+--threshold, for use in CI.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import corpus  # noqa: E402
+from http_load import run_load, wait_until_up  # noqa: E402
+
+DEFAULT_PATHS = (
+    '/',
+    '/api/catalog',
+    '/api/photos?per_page=24',
+    '/api/photos?per_page=24&sort_by=location',
+    '/api/clusters?bbox=129.0,30.0,146.0,42.0&zoom=6',
+    '/api/search?q=temple',
+    '/api/facets',
+    '/api/facets?location=Kyoto%2C%20Kyoto%20Prefecture',
+)
+
+STUB_APPS = {'anthropic': 'stub_servers:anthropic_app', 'nominatim': 'stub_servers:nominatim_app',
+             'serpapi': 'stub_servers:serpapi_app'}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+def start_uvicorn(app, port, cwd, workers=1, env=None):
+    return subprocess.Popen([
+        sys.executable, '-m', 'uvicorn', app, '--app-dir', REPO,
+        '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers),
+        '--log-level', 'warning', '--no-access-log',
+    ], cwd=cwd, env=env)
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def bench_ingest(workdir, args):
+    """Run process_images.py on a fresh synthetic corpus against the stub APIs"""
+    os.makedirs(workdir)
+    corpus.write_images(os.path.join(workdir, 'photos'), args.ingest_photos, args.seed, tuple(args.image_size))
+    ports = {name: free_port() for name in STUB_APPS}
+    stub_env = dict(os.environ, STUB_LATENCY_MS=str(args.stub_latency_ms), STUB_BATCH_SECONDS='1')
+    stubs = [start_uvicorn(STUB_APPS[name], ports[name], workdir, env=stub_env) for name in STUB_APPS]
+    try:
+        for port in ports.values():
+            wait_for_port(port)
+        env = dict(
+            os.environ,
+            ANTHROPIC_API_KEY='stub', SERP_API_KEY='stub',
+            ANTHROPIC_BASE_URL=f"http://127.0.0.1:{ports['anthropic']}",
+            NOMINATIM_URL=f"http://127.0.0.1:{ports['nominatim']}",
+            SERPAPI_URL=f"http://127.0.0.1:{ports['serpapi']}",
+        )
+        # The stubs don't rate limit, so neither do we: this measures our pipeline
+        command = [
+            sys.executable, os.path.join(REPO, 'process_images.py'),
+            '--geocode-rate', '10000', '--map-rate', '10000', '--caption-rate', '10000',
+            '--report-path', 'ingest-report.json', *args.ingest_args,
+        ]
+        started = time.perf_counter()
+        subprocess.run(command, cwd=workdir, env=env, check=True,
+                       stdout=None if args.verbose else subprocess.DEVNULL)
+        elapsed = time.perf_counter() - started
+    finally:
+        stop(stubs)
+
+    with open(os.path.join(workdir, 'ingest-report.json')) as f:
+        report = json.load(f)
+    written = sum(c['value'] for c in report['counters'] if c['name'] == 'photos_written_total')
+    return {
+        'photos': args.ingest_photos,
+        'written': written,
+        'seconds': round(elapsed, 3),
+        'photos_per_second': round(written / elapsed, 2) if elapsed else None,
+        'bottleneck': report['bottleneck'],
+        'stage_utilization': report['stage_utilization'],
+        'stage_seconds': {
+            h['labels']['stage']: {key: h[key] for key in ('count', 'mean', 'p50', 'p95', 'max')}
+            for h in report['histograms'] if h['name'] == 'stage_seconds'
+        },
+        'step_seconds': {
+            h['labels']['step']: {key: h[key] for key in ('count', 'mean', 'p95')}
+            for h in report['histograms'] if h['name'] == 'step_seconds'
+        },
+    }
+
+def payload_size(port, path, encoding):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        conn.request('GET', path, headers={'Accept-Encoding': encoding})
+        response = conn.getresponse()
+        return len(response.read())
+    finally:
+        conn.close()
+
+def bench_serving(workdir, photos, args):
+    """Fill photos.db with `photos` synthetic rows and load the app with each path"""
+    os.makedirs(workdir)
+    os.symlink(os.path.join(REPO, 'templates'), os.path.join(workdir, 'templates'))
+    shutil.copytree(os.path.join(REPO, 'static'), os.path.join(workdir, 'static'),
+                    ignore=shutil.ignore_patterns('photos'))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        fill_seconds = corpus.fill_database(photos, args.seed)
+    finally:
+        os.chdir(cwd)
+
+    port = free_port()
+    server = start_uvicorn('app:app', port, workdir, workers=args.workers)
+    try:
+        wait_until_up(port, timeout=120)
+        results = {}
+        for path in args.path:
+            # One pass to load the catalog and warm caches, then the measured run
+            run_load(port, [path], args.concurrency, min(1.0, args.duration), args.client_processes)
+            result = run_load(port, [path], args.concurrency, args.duration, args.client_processes)
+            result['bytes'] = {encoding: payload_size(port, path, encoding) for encoding in ('identity', 'gzip')}
+            results[path] = result
+            latency = result['latency_ms']
+            print(f"  {path}: {result['requests_per_second']} req/s, p50 {latency['p50']} ms, "
+                  f"p99 {latency['p99']} ms, {result['bytes']['identity']} bytes "
+                  f"({result['bytes']['gzip']} gzipped)")
+    finally:
+        stop([server])
+    return {'photos': photos, 'fill_seconds': round(fill_seconds, 3), 'paths': results}
+
+def comparable_values(results):
+    """{label: (value, True if bigger is better)} for every headline figure in a results file"""
+    values = {}
+    if results.get('ingest'):
+        values['ingest photos/s'] = (results['ingest']['photos_per_second'], True)
+    for scale in results.get('scales', []):
+        for path, result in scale['paths'].items():
+            label = f"{scale['photos']} photos {path}"
+            values[f'{label} req/s'] = (result['requests_per_second'], True)
+            values[f'{label} p95 ms'] = (result['latency_ms']['p95'], False)
+            values[f'{label} bytes'] = (result['bytes']['identity'], False)
+    return values
+
+def compare(baseline, current, threshold):
+    """Print the change of every shared measurement; return how many regressed past threshold"""
+    before, after = comparable_values(baseline), comparable_values(current)
+    regressions = 0
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    for label, (value, higher_is_better) in after.items():
+        old = before.get(label, (None,))[0]
+        if old in (None, 0) or value is None:
+            continue
+        change = (value - old) / old
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+        print(f"  {label}: {old} -> {value} ({change:+.1%}){flag}")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[100, 10000, 100000],
+                        help='catalog sizes to measure the API at')
+    parser.add_argument('--ingest-photos', type=int, default=100,
+                        help='photos to run through ingest (0 skips the ingest benchmark)')
+    parser.add_argument('--image-size', type=int, nargs=2, default=(2048, 1536), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--stub-latency-ms', type=float, default=0,
+                        help='delay the stub APIs add to each response')
+    parser.add_argument('--ingest-args', nargs=argparse.REMAINDER, default=[],
+                        help='extra process_images.py options, e.g. --ingest-args --caption-workers 8')
+    parser.add_argument('--path', action='append', help='request path to load, repeatable')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn workers')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of load per path')
+    parser.add_argument('--client-processes', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='scratch directory (default: a new temporary directory)')
+    parser.add_argument('--keep', action='store_true', help="don't delete the scratch directory")
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative change counted as a regression (default 0.10)')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--verbose', action='store_true', help="show process_images.py's output")
+    args = parser.parse_args(argv)
+    args.path = args.path or list(DEFAULT_PATHS)
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='photo-bench-')
+    commit, dirty = git_commit()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': {key: value for key, value in vars(args).items()
+                     if key not in ('output', 'compare', 'workdir', 'keep', 'verbose', 'fail_on_regression')},
+        'ingest': None,
+        'scales': [],
+    }
+    try:
+        if args.ingest_photos:
+            print(f"Ingesting {args.ingest_photos} synthetic photos against the stub APIs...")
+            results['ingest'] = bench_ingest(os.path.join(workdir, 'ingest'), args)
+            print(f"  {results['ingest']['photos_per_second']} photos/s, "
+                  f"bottleneck: {results['ingest']['bottleneck']}")
+        for photos in args.scales:
+            print(f"Serving {photos} photos...")
+            results['scales'].append(bench_serving(os.path.join(workdir, f'scale-{photos}'), photos, args))
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
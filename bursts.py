@@ -0,0 +1,208 @@
+"""Group near-identical burst shots so only one photo per burst is captioned.
+
+Each photo gets a 64-bit difference hash (dHash) of its decoded pixels. Two
+photos are a burst when they are by the same photographer, were taken within
+BURST_SECONDS of each other, within BURST_METERS (or both without GPS), and
+their hashes differ in at most BURST_DISTANCE bits. Photos are indexed by
+capture time bucket, so each one is only compared with the few photos taken
+around the same moment, never with the whole run.
+
+The first photo of a burst becomes its representative and goes through
+geocoding, the map lookup and captioning as usual. The others are held until
+the representative is captioned, then written with its caption, location and
+points of interest and with photo.burst_of pointing at it.
+"""
+import json
+import math
+import sqlite3
+import threading
+from datetime import datetime
+from PIL import Image
+from metrics import metrics
+from pipeline import DatabaseWriter, exif_datetime_to_iso
+
+BURST_DISTANCE = 10  # differing bits out of 64; time and place rule out most false matches
+BURST_SECONDS = 10.0
+BURST_METERS = 50.0
+
+# What a sibling takes over from its representative
+SHARED_FIELDS = ('caption', 'points_of_interest', 'location_name', 'map_image_path')
+
+def dhash(image, size=8):
+    """Difference hash of a PIL image as 16 hex digits: is each pixel brighter than its right neighbour"""
+    small = image.convert('L').resize((size + 1, size), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for column in range(size):
+            value = (value << 1) | (pixels[offset + column] > pixels[offset + column + 1])
+    return f'{value:0{size * size // 4}x}'
+
+def hamming(a, b):
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+def distance_meters(lat1, lon1, lat2, lon2):
+    """Equirectangular approximation; exact enough at burst distances"""
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371000 * math.hypot(x, y)
+
+def _timestamp(taken_at):
+    return datetime.fromisoformat(taken_at).timestamp() if taken_at else None
+
+class _Group:
+    def __init__(self, relative_path, photographer, timestamp, latitude, longitude, dhash):
+        self.relative_path = relative_path
+        self.photographer = photographer
+        self.timestamp = timestamp
+        self.latitude = latitude
+        self.longitude = longitude
+        self.dhash = dhash
+        self.shared = None  # SHARED_FIELDS once the representative is captioned
+        self.siblings = []
+
+class BurstGroups:
+    """Pipeline stage that holds back burst siblings until their representative is captioned.
+
+    `assign` is the stage function, right after the local stage. Captioned
+    records pass through `put` on their way to the database writer, which
+    releases any siblings waiting on them. Siblings of representatives saved
+    by an earlier run, or captioned through a message batch, are written by
+    `release_written` once the pipeline has finished.
+    """
+    def __init__(self, db_path='photos.db', max_distance=BURST_DISTANCE, window=BURST_SECONDS,
+                 max_meters=BURST_METERS):
+        self.db_path = db_path
+        self.max_distance = max_distance
+        self.window = window
+        self.max_meters = max_meters
+        self.lock = threading.Lock()
+        self.buckets = {}  # int(timestamp // window) -> [_Group]
+        self.groups = {}  # relative_path of the representative -> _Group
+        self.next_stage = None
+        self.siblings = 0
+        self._load_written()
+
+    def _load_written(self):
+        """Index representatives already in the database, so new shots can join their bursts"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            rows = conn.execute('''
+                SELECT file_path, photographer, taken_at, latitude, longitude, dhash FROM photo
+                WHERE dhash IS NOT NULL AND taken_at IS NOT NULL AND burst_of IS NULL
+            ''').fetchall()
+        finally:
+            conn.close()
+        for file_path, photographer, taken_at, latitude, longitude, hash_value in rows:
+            self._index(_Group(file_path, photographer, _timestamp(taken_at), latitude, longitude, hash_value))
+
+    def _index(self, group):
+        self.groups[group.relative_path] = group
+        self.buckets.setdefault(int(group.timestamp // self.window), []).append(group)
+
+    def then(self, next_stage):
+        self.next_stage = next_stage
+        return next_stage
+
+    def _matches(self, group, record, timestamp):
+        if group.photographer != record['photographer'] or abs(group.timestamp - timestamp) > self.window:
+            return False
+        if (group.latitude is None) != (record['latitude'] is None):
+            return False
+        if group.latitude is not None and distance_meters(
+                group.latitude, group.longitude, record['latitude'], record['longitude']) > self.max_meters:
+            return False
+        return hamming(group.dhash, record['dhash']) <= self.max_distance
+
+    def _find(self, record, timestamp):
+        bucket = int(timestamp // self.window)
+        candidates = [
+            group for key in (bucket - 1, bucket, bucket + 1) for group in self.buckets.get(key, ())
+            if group.relative_path != record['relative_path'] and self._matches(group, record, timestamp)
+        ]
+        return min(candidates, key=lambda group: hamming(group.dhash, record['dhash']), default=None)
+
+    def assign(self, record, limiter):
+        """Pass representatives on; hold siblings, or send them straight to the writer if possible"""
+        timestamp = _timestamp(exif_datetime_to_iso(record['date_taken']))
+        if not record.get('dhash') or timestamp is None:
+            return record
+        forward = False
+        with self.lock:
+            group = self._find(record, timestamp)
+            if group is None:
+                self._index(_Group(record['relative_path'], record['photographer'], timestamp,
+                                   record['latitude'], record['longitude'], record['dhash']))
+                return record
+            # The model image is only needed for captioning; don't hold it
+            record.pop('prepared', None)
+            record['burst_of'] = group.relative_path
+            self.siblings += 1
+            if group.shared is not None:
+                record.update(group.shared)
+                forward = True
+            else:
+                group.siblings.append(record)
+        metrics.count('burst_siblings_total')
+        print(f"{record['relative_path']} is a burst shot of {group.relative_path}; reusing its caption")
+        if forward:
+            self.next_stage.put(record)
+        return None
+
+    def put(self, record):
+        """A captioned record on its way to the writer: pass it on, then any siblings waiting on it"""
+        # The representative must reach the writer first, so its siblings can refer to its row
+        self.next_stage.put(record)
+        with self.lock:
+            group = self.groups.get(record['relative_path'])
+            if group is None or record.get('burst_of'):
+                return
+            group.shared = {field: record.get(field) for field in SHARED_FIELDS}
+            siblings, group.siblings = group.siblings, []
+        for sibling in siblings:
+            sibling.update(group.shared)
+            self.next_stage.put(sibling)
+
+    def close(self):
+        if self.next_stage is not None:
+            self.next_stage.close()
+
+    def release_written(self, db_batch_size=25):
+        """Write siblings still held whose representative is now in the database; returns how many"""
+        with self.lock:
+            waiting = {path: group.siblings for path, group in self.groups.items() if group.siblings}
+            for group in self.groups.values():
+                group.siblings = []
+        if not waiting:
+            return 0
+        conn = sqlite3.connect(self.db_path)
+        writer = DatabaseWriter(db_path=self.db_path, batch_size=db_batch_size)
+        writer.start()
+        unresolved = 0
+        try:
+            for relative_path, siblings in waiting.items():
+                row = conn.execute('SELECT id, caption, location_name FROM photo WHERE file_path = ?',
+                                   (relative_path,)).fetchone()
+                if row is None:
+                    # The representative failed; its siblings are picked up again next run
+                    unresolved += len(siblings)
+                    continue
+                photo_id, caption_text, location_name = row
+                points_of_interest = json.dumps([
+                    {'name': name, 'description': description}
+                    for name, description in conn.execute(
+                        'SELECT name, description FROM point_of_interest WHERE photo_id = ? ORDER BY id',
+                        (photo_id,)
+                    )
+                ])
+                for sibling in siblings:
+                    sibling.update(caption=caption_text, location_name=location_name,
+                                   points_of_interest=points_of_interest, map_image_path=None)
+                    writer.put(sibling)
+        finally:
+            writer.close()
+            conn.close()
+        if unresolved:
+            print(f"Left {unresolved} burst shots for the next run: their representative wasn't saved")
+        return writer.written
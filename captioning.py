@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import base64
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from io import BytesIO
+from typing import List
+from PIL import Image
+from anthropic import Anthropic, APIError
+import instructor
+from pydantic import BaseModel
+from metrics import metrics
+
+CAPTION_MODEL = 'claude-3-5-sonnet-latest'
+
+# Ships with the code, so it's found wherever the photo library is
+CAPTION_PROMPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompts', 'caption.txt')
+
+# Splits a prompt file into the shared instructions and the per-photo part
+PHOTO_SECTION_MARKER = '=== per photo ==='
+
+# Shortest prefix the API will cache for Sonnet (Haiku needs 2048); shorter ones are billed in full
+MIN_CACHE_TOKENS = 1024
+
+class PointOfInterest(BaseModel):
+    name: str
+    description: str
+
+class PhotoAnalysis(BaseModel):
+    caption: str
+    points_of_interest: List[PointOfInterest]
+
+
+# Tool definition used when calling the API directly (e.g. message batches)
+# rather than through instructor, so responses still parse into PhotoAnalysis
+CAPTION_TOOL = {
+    'name': 'PhotoAnalysis',
+    'description': 'Record the caption and points of interest for the photo',
+    'input_schema': PhotoAnalysis.model_json_schema(),
+}
+
+_anthropic_client = None
+_instructor_client = None
+_client_lock = threading.Lock()
+
+def get_anthropic_client():
+    """Plain Anthropic client shared by the whole process"""
+    global _anthropic_client
+    with _client_lock:
+        if _anthropic_client is None:
+            _anthropic_client = Anthropic(api_key=os.environ['ANTHROPIC_API_KEY'])
+        return _anthropic_client
+
+def get_instructor_client():
+    """Instructor-wrapped client shared by every caption call in the process"""
+    global _instructor_client
+    client = get_anthropic_client()
+    with _client_lock:
+        if _instructor_client is None:
+            _instructor_client = instructor.from_anthropic(client)
+        return _instructor_client
+
+@dataclass(frozen=True)
+class CaptionPrompt:
+    """A caption prompt: instructions shared by every photo, then a template for one photo's facts"""
+    instructions: str
+    photo_template: str
+
+    def system(self):
+        # The instructions never change between photos, so they are cached as a prefix
+        # (with the tool definition ahead of them) and only billed in full once per cache window
+        return [{'type': 'text', 'text': self.instructions, 'cache_control': {'type': 'ephemeral'}}]
+
+    def photo_text(self, photographer, date_taken, location_name):
+        return self.photo_template.format(
+            photographer=photographer,
+            date_taken=date_taken,
+            location_name=location_name or 'unknown',
+            location_context=f" The photo was taken in {location_name}." if location_name else '',
+        )
+
+@lru_cache(maxsize=None)
+def load_prompt(path=CAPTION_PROMPT_PATH):
+    """Read a prompt file: instructions, a '=== per photo ===' line, then the per-photo template.
+
+    The template is filled with str.format(); it can use {photographer},
+    {date_taken}, {location_name} and {location_context}.
+    """
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    instructions, marker, photo_template = text.partition(f'\n{PHOTO_SECTION_MARKER}\n')
+    if not marker:
+        raise ValueError(f"{path} has no '{PHOTO_SECTION_MARKER}' line separating the per-photo part")
+    prompt = CaptionPrompt(instructions.strip(), photo_template.strip())
+    # Fail now, not on the first photo, if the template uses an unknown field
+    prompt.photo_text('', '', '')
+    return prompt
+
+def prefix_tokens(prompt):
+    """Tokens in the cached prefix (tool definition and instructions), as the API counts them"""
+    client = get_anthropic_client()
+    probe = [{'role': 'user', 'content': 'photo'}]
+    with_prefix = client.messages.count_tokens(model=CAPTION_MODEL, system=prompt.system(),
+                                               tools=[CAPTION_TOOL], messages=probe)
+    without = client.messages.count_tokens(model=CAPTION_MODEL, messages=probe)
+    return with_prefix.input_tokens - without.input_tokens
+
+def check_prompt_caching(prompt):
+    """Warn when the prompt is too short to be cached; returns whether it will be (None if unknown)"""
+    try:
+        tokens = prefix_tokens(prompt)
+    except Exception as e:
+        print(f"Warning: couldn't count the caption prompt's tokens: {str(e)}")
+        return None
+    if tokens < MIN_CACHE_TOKENS:
+        print(f"Warning: the caption prompt's instructions and tool definition are {tokens} tokens, "
+              f"below the {MIN_CACHE_TOKENS} the API caches; every photo pays for them in full")
+        return False
+    print(f"Caption prompt prefix is {tokens} tokens and will be cached")
+    return True
+
+def points_of_interest_json(analysis):
+    return json.dumps([poi.model_dump() for poi in analysis.points_of_interest])
+
+def record_usage(usage, relative_path=None):
+    """Count a response's token usage, in total and for the photo being captioned"""
+    if usage is None:
+        return
+    amounts = {
+        'input_tokens': usage.input_tokens,
+        'output_tokens': usage.output_tokens,
+        'cache_creation_input_tokens': getattr(usage, 'cache_creation_input_tokens', None) or 0,
+        'cache_read_input_tokens': getattr(usage, 'cache_read_input_tokens', None) or 0,
+    }
+    for kind, amount in amounts.items():
+        metrics.count('tokens_total', amount, kind=kind.removesuffix('_tokens'))
+    metrics.add_photo_usage(relative_path, **amounts)
+    print(f"Tokens for {relative_path or getattr(metrics.local, 'photo', None) or 'caption'}: "
+          f"{amounts['input_tokens']} input, {amounts['output_tokens']} output, "
+          f"{amounts['cache_read_input_tokens']} read from cache, "
+          f"{amounts['cache_creation_input_tokens']} written to cache")
+
+def parse_tool_response(message):
+    """Extract a PhotoAnalysis from a raw Messages API response that used CAPTION_TOOL"""
+    for block in message.content:
+        if block.type == 'tool_use' and block.name == CAPTION_TOOL['name']:
+            return PhotoAnalysis.model_validate(block.input)
+    raise ValueError("Response did not include a PhotoAnalysis tool call")
+
+def encode_map_image(map_image_path):
+    """Base64 a map image, passing JPEG/PNG bytes through without re-encoding"""
+    with Image.open(map_image_path) as img:
+        media_type = Image.MIME.get(img.format)
+        if media_type in ('image/jpeg', 'image/png'):
+            with open(map_image_path, 'rb') as f:
+                return base64.b64encode(f.read()).decode('utf-8'), media_type
+        buffer = BytesIO()
+        img.convert('RGB').save(buffer, format='JPEG')
+        return base64.b64encode(buffer.getvalue()).decode('utf-8'), 'image/jpeg'
+
+def build_caption_request(prepared, photographer, map_image_path=None, location_name=None, prompt=None):
+    """Build the Messages API parameters (system, messages, ...) for captioning one photo.
+
+    The system prompt is the same for every photo and marked for prompt
+    caching; only the per-photo facts and the images follow it.
+    """
+    prompt = prompt or load_prompt()
+    date_taken = prepared.exif_data.get('DateTimeOriginal', 'unknown date/time')
+    messages_content = [{'type': 'text', 'text': prompt.photo_text(photographer, date_taken, location_name)}]
+
+    if map_image_path is not None:
+        try:
+            print("Processing map image...")
+            map_image_base64, map_media_type = encode_map_image(map_image_path)
+            messages_content.append({
+                'type': 'image',
+                'source': {
+                    'type': 'base64',
+                    'media_type': map_media_type,
+                    'data': map_image_base64
+                }
+            })
+        except Exception as e:
+            print(f"Warning: Failed to process map image: {str(e)}")
+
+    messages_content.append({
+        'type': 'image',
+        'source': {
+            'type': 'base64',
+            'media_type': 'image/jpeg',
+            'data': prepared.model_image_base64
+        }
+    })
+
+    return {
+        'model': CAPTION_MODEL,
+        'max_tokens': 1000,
+        'messages': [{
+            'role': 'user',
+            'content': messages_content
+        }],
+        'system': prompt.system(),
+        'temperature': 0,
+    }
+
+def generate_caption(prepared, photographer, map_image_path=None, location_name=None, prompt=None):
+    """Caption a PreparedImage, retrying with exponential backoff when rate limited"""
+    max_retries = 3
+    base_delay = 5  # seconds
+    request = build_caption_request(prepared, photographer, map_image_path, location_name, prompt)
+    request_bytes = len(json.dumps(request))
+    
+    for attempt in range(max_retries):
+        try:
+            print("Generating caption and points of interest...")
+            anthropic_client = get_instructor_client()
+
+            print("Sending request to Claude API...")
+            metrics.count('api_bytes_sent_total', request_bytes, api='anthropic')
+            with metrics.timer('api_seconds', api='anthropic'):
+                response, completion = anthropic_client.messages.create_with_completion(
+                    **request,
+                    response_model=PhotoAnalysis,
+                )
+            metrics.count('api_calls_total', api='anthropic', status=200)
+            record_usage(getattr(completion, 'usage', None))
+
+            return response.caption, points_of_interest_json(response)
+            
+        except APIError as e:
+            metrics.count('api_calls_total', api='anthropic', status=getattr(e, 'status_code', None) or 'error')
+            if e.status_code == 429:  # Rate limit error
+                if attempt < max_retries - 1:
+                    metrics.count('api_retries_total', api='anthropic')
+                    delay = base_delay * (2 ** attempt)  # Exponential backoff
+                    print(f"Rate limited. Waiting {delay} seconds before retry {attempt + 1}/{max_retries}")
+                    time.sleep(delay)
+                    continue
+            print(f"API error after {attempt + 1} attempts: {str(e)}")
+            raise
+        except Exception as e:
+            metrics.count('api_calls_total', api='anthropic', status='error')
+            print(f"Error generating caption and points of interest: {str(e)}")
+            return "Error generating caption", "[]"
+
@@ -0,0 +1,124 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+from database import connect_readonly
+
+# Everything the page needs per photo; exif_data and the rest stay server-side
+CATALOG_FIELDS = (
+    'id', 'file_path', 'caption', 'location_name', 'date_taken',
+    'latitude', 'longitude', 'points_of_interest', 'derivatives', 'burst_of', 'deep_zoom'
+)
+
+# The photo columns behind CATALOG_FIELDS; date_taken is served from taken_at
+PHOTO_COLUMNS = ', '.join(
+    'taken_at' if field == 'date_taken' else field
+    for field in CATALOG_FIELDS if field != 'points_of_interest'
+)
+
+def parse_taken_at(value):
+    return datetime.fromisoformat(value) if value else None
+
+def parse_json(value):
+    return json.loads(value) if value else None
+
+def to_json_photo(photo):
+    """JSON-safe copy of a catalog photo (what serialize_photos used to produce)"""
+    data = dict(photo)
+    if data['date_taken'] is not None:
+        data['date_taken'] = data['date_taken'].strftime('%Y-%m-%d %H:%M:%S')
+    return data
+
+class CatalogSnapshot:
+    """Immutable in-memory copy of photos.db, in date order, with its JSON built once"""
+    def __init__(self, photos, version):
+        self.version = version
+        self.photos = photos
+        self.sorted = {'date-asc': self._sort(photos)}
+        self._catalog_json = None
+
+    @property
+    def catalog_json(self):
+        """(body, etag) of the compact catalog sent to the page, built once per snapshot"""
+        if self._catalog_json is None:
+            rows = []
+            for photo in self.sorted['date-asc']:
+                data = to_json_photo(photo)
+                rows.append([data[field] for field in CATALOG_FIELDS])
+            body = json.dumps({'fields': CATALOG_FIELDS, 'rows': rows}, separators=(',', ':')).encode()
+            etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+            self._catalog_json = (body, etag)
+        return self._catalog_json
+
+    @staticmethod
+    def _sort(photos):
+        # Mirrors the old SQL ORDER BY taken_at NULLS LAST, with id as a stable tiebreak
+        dated = sorted((p for p in photos if p['date_taken']), key=lambda p: (p['date_taken'], p['id']))
+        return dated + [p for p in photos if not p['date_taken']]
+
+class PhotoCatalog:
+    """Application-wide catalog, loaded once and reloaded only when photos.db changes.
+
+    Changes are detected with PRAGMA data_version on a long-lived connection,
+    which moves whenever another connection (e.g. ingest) commits, plus the
+    file's inode so a replaced database file is noticed too.
+    """
+    def __init__(self, db_path='photos.db'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = None
+        self.conn_inode = None
+        self.snapshot = None
+
+    def _current_version(self):
+        try:
+            inode = os.stat(self.db_path).st_ino
+        except FileNotFoundError:
+            return None
+        if self.conn is None or self.conn_inode != inode:
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = connect_readonly(self.db_path)
+            self.conn_inode = inode
+        return inode, self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def get(self):
+        """Return the current snapshot, reloading it first if the database changed"""
+        with self.lock:
+            version = self._current_version()
+            if self.snapshot is None or self.snapshot.version != version:
+                self.snapshot = self._load(version)
+            return self.snapshot
+
+    def _load(self, version):
+        if version is None:
+            return CatalogSnapshot([], version)
+        self.conn.row_factory = sqlite3.Row
+        try:
+            # One read transaction so photos and POIs come from the same commit
+            self.conn.execute('BEGIN')
+            photos = []
+            for row in self.conn.execute(f'SELECT {PHOTO_COLUMNS} FROM photo'):
+                photo = dict(row)
+                photo['date_taken'] = parse_taken_at(photo.pop('taken_at'))
+                photo['derivatives'] = parse_json(photo.get('derivatives'))
+                photo['points_of_interest'] = []
+                photos.append(photo)
+            by_id = {photo['id']: photo for photo in photos}
+            for row in self.conn.execute(
+                'SELECT photo_id, name, description FROM point_of_interest ORDER BY id'
+            ):
+                photo = by_id.get(row['photo_id'])
+                if photo is not None:
+                    photo['points_of_interest'].append({'name': row['name'], 'description': row['description']})
+        except sqlite3.OperationalError as e:
+            # Database exists but hasn't been set up yet
+            print(f"Catalog not loaded: {str(e)}")
+            photos = []
+        finally:
+            self.conn.rollback()
+            self.conn.row_factory = None
+        print(f"Loaded catalog with {len(photos)} photos")
+        return CatalogSnapshot(photos, version)
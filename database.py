@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import phase
+
+# Per-connection read settings: memory-map up to 256 MB of the file and keep a
+# 32 MB page cache, so hot pages are served without read() syscalls
+READ_PRAGMAS = (
+    'PRAGMA query_only = ON',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA cache_size = -32000',
+    'PRAGMA temp_store = MEMORY',
+)
+
+def dict_factory(cursor, row):
+    return {col[0]: value for col, value in zip(cursor.description, row)}
+
+def connect_readonly(db_path='photos.db'):
+    """Connection for the web app: queries only, tuned for reads.
+
+    Opened read-write with query_only rather than mode=ro, because readers of a
+    WAL database need to be able to create the -shm file.
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    for pragma in READ_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class Database:
+    """Read-only access to photos.db that keeps blocking SQLite calls off the event loop.
+
+    Queries run on a small dedicated thread pool and every thread keeps its own
+    connection for the life of the app, so there's no connect per request and
+    no connection is ever shared between threads. `await db.run(func, *args)`
+    calls `func(conn, *args)` on one of those threads.
+    """
+    def __init__(self, db_path='photos.db', workers=4):
+        self.db_path = db_path
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def _connection(self):
+        # A replaced photos.db (e.g. restored from backup) gets a fresh connection
+        inode = os.stat(self.db_path).st_ino
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.inode != inode:
+            with self.lock:
+                if conn is not None:
+                    conn.close()
+                    self.connections.remove(conn)
+                conn = connect_readonly(self.db_path)
+                conn.row_factory = dict_factory
+                self.connections.append(conn)
+            self.local.conn, self.local.inode = conn, inode
+        return conn
+
+    def _call(self, func, args):
+        return func(self._connection(), *args)
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        # Includes any wait for a free thread, which is part of what the request pays for SQLite
+        with phase('db'):
+            return await loop.run_in_executor(self.executor, self._call, func, args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
@@ -0,0 +1,109 @@
+"""Deep Zoom (DZI) tile pyramids for the full-screen viewer.
+
+A photo larger than the 'full' derivative gets a pyramid next to it in
+static/photos:
+
+    Dan/x.3f2a9c01b7de.dzi                 size, tile size and format (XML)
+    Dan/x.3f2a9c01b7de_files/<level>/<column>_<row>.jpg
+
+Level 0 is 1x1 pixel and every level doubles the one before it, up to the
+original size at the top. Each level is cut into TILE_SIZE tiles (plus
+OVERLAP pixels shared with each neighbour), so a viewer such as
+OpenSeadragon shows a small level first and then fetches only the tiles in
+view at the current zoom. The hash in the name covers every tile, and the
+directory is put in place in one rename and never changed afterwards, so
+static_files.py serves all of it as immutable.
+"""
+import glob
+import hashlib
+import io
+import math
+import os
+import shutil
+from PIL import ImageOps
+from derivatives import DERIVATIVE_SIZES, HASH_LENGTH
+
+TILE_SIZE = 254  # 256 with the overlap on both sides, the usual DZI layout
+OVERLAP = 1
+# JPEG encodes a pyramid ~25x faster than WebP for ~10% more bytes, and every DZI viewer reads it
+TILE_FORMAT = 'jpg'
+TILE_OPTIONS = {'format': 'JPEG', 'quality': 85}
+
+# Photos no larger than the 'full' derivative are already shown at full resolution
+MIN_EDGE = DERIVATIVE_SIZES['full']
+
+DZI_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{format}" Overlap="{overlap}" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+'''
+
+def levels(width, height):
+    """(level, width, height) from the full size down to 1x1, each half the one above, rounded up"""
+    top = math.ceil(math.log2(max(width, height)))
+    for level in range(top, -1, -1):
+        scale = 1 << (top - level)
+        yield level, math.ceil(width / scale), math.ceil(height / scale)
+
+def tile_boxes(width, height, tile_size=TILE_SIZE, overlap=OVERLAP):
+    """((column, row), crop box) for every tile of a level"""
+    for column in range(math.ceil(width / tile_size)):
+        for row in range(math.ceil(height / tile_size)):
+            left, top = column * tile_size, row * tile_size
+            yield (column, row), (max(left - overlap, 0), max(top - overlap, 0),
+                                  min(left + tile_size + overlap, width), min(top + tile_size + overlap, height))
+
+def _remove_stale(output_root, relative_path, keep):
+    stem = glob.escape(os.path.join(output_root, os.path.splitext(relative_path)[0]))
+    hashed = '[0-9a-f]' * HASH_LENGTH
+    for path in glob.glob(f'{stem}.{hashed}.dzi') + glob.glob(f'{stem}.{hashed}_files'):
+        if not path.startswith(keep):
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+def generate_pyramid(image, relative_path, output_root='static/photos', min_edge=MIN_EDGE):
+    """Write the DZI pyramid of `image` next to the original; returns the .dzi path, or None if too small"""
+    image = ImageOps.exif_transpose(image)
+    if max(image.size) <= min_edge:
+        return None
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    stem = os.path.splitext(relative_path)[0]
+    staging = os.path.join(output_root, f'{stem}.tmp{os.getpid()}_files')
+    shutil.rmtree(staging, ignore_errors=True)
+    digest = hashlib.sha256()
+    width, height = image.size
+    level_image = image
+    for level, level_width, level_height in levels(width, height):
+        if level_image.size != (level_width, level_height):
+            # Box-filter halving; reduce() rounds up exactly like the DZI level sizes
+            level_image = level_image.reduce(2)
+        os.makedirs(os.path.join(staging, str(level)))
+        for (column, row), box in tile_boxes(level_width, level_height):
+            buffer = io.BytesIO()
+            level_image.crop(box).save(buffer, **TILE_OPTIONS)
+            digest.update(buffer.getvalue())
+            with open(os.path.join(staging, str(level), f'{column}_{row}.{TILE_FORMAT}'), 'wb') as f:
+                f.write(buffer.getvalue())
+
+    content_hash = digest.hexdigest()[:HASH_LENGTH]
+    tiles_dir = os.path.join(output_root, f'{stem}.{content_hash}_files')
+    if os.path.exists(tiles_dir):
+        # Same pixels as last time
+        shutil.rmtree(staging)
+    else:
+        os.replace(staging, tiles_dir)
+    dzi_path = f'{stem}.{content_hash}.dzi'
+    with open(os.path.join(output_root, dzi_path), 'w') as f:
+        f.write(DZI_TEMPLATE.format(format=TILE_FORMAT, overlap=OVERLAP, tile_size=TILE_SIZE,
+                                    width=width, height=height))
+    _remove_stale(output_root, relative_path, os.path.join(output_root, f'{stem}.{content_hash}'))
+    return dzi_path
+
+def pyramid_files(dzi_path, output_root='static/photos'):
+    """Every file of a pyramid relative to output_root: the .dzi, then its tiles"""
+    tiles_dir = dzi_path[:-len('.dzi')] + '_files'
+    yield dzi_path
+    for level in sorted(os.listdir(os.path.join(output_root, tiles_dir)), key=int):
+        for name in sorted(os.listdir(os.path.join(output_root, tiles_dir, level))):
+            yield os.path.join(tiles_dir, level, name)
@@ -0,0 +1,101 @@
+import glob
+import hashlib
+import io
+import os
+from PIL import Image, ImageOps, features
+
+# Longest edge in pixels for each derivative, sized for 2x displays:
+# 80px map markers, ~320px grid cards, 400px popups and the full-screen modal.
+DERIVATIVE_SIZES = {
+    'marker': 160,
+    'thumb': 640,
+    'popup': 800,
+    'full': 2048,
+}
+
+# Derivatives that are shown cropped to a square (object-cover circles)
+SQUARE_DERIVATIVES = {'marker'}
+
+ENCODE_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'avif': {'format': 'AVIF', 'quality': 60},
+}
+
+def avif_available():
+    """True if this Pillow build (or the pillow-avif-plugin) can write AVIF"""
+    try:
+        if features.check('avif'):
+            return True
+    except ValueError:
+        pass
+    try:
+        import pillow_avif  # noqa: F401 - registers the AVIF plugin
+        return True
+    except ImportError:
+        return False
+
+def register_heif():
+    """Let Pillow open HEIC/HEIF photos if the optional pillow-heif package is installed"""
+    try:
+        from pillow_heif import register_heif_opener
+    except ImportError:
+        return False
+    register_heif_opener()
+    return True
+
+# Hex digits of the content hash in derivative file names (see static_files.py)
+HASH_LENGTH = 12
+
+def derivative_path(relative_path, size_name, fmt, content_hash):
+    """Path of a derivative relative to static/photos, stored next to the original.
+
+    The name carries a hash of the encoded file, e.g. 'Dan/x.thumb.3f2a9c01b7de.webp',
+    so its URL changes whenever the content does and can be cached forever.
+    """
+    stem, _ = os.path.splitext(relative_path)
+    return f"{stem}.{size_name}.{content_hash[:HASH_LENGTH]}.{fmt}"
+
+def _remove_stale(output_root, relative_path, size_name, fmt, keep):
+    """Delete earlier encodings of a derivative, hashed or from before names were hashed"""
+    stem = glob.escape(os.path.join(output_root, os.path.splitext(relative_path)[0]))
+    pattern = f"{stem}.{size_name}.{'[0-9a-f]' * HASH_LENGTH}.{fmt}"
+    for path in glob.glob(pattern) + glob.glob(f"{stem}.{size_name}.{fmt}"):
+        if path != keep:
+            os.remove(path)
+
+def generate_derivatives(image, relative_path, output_root='static/photos', formats=('webp',)):
+    """Write every derivative size of `image` in each format next to the original.
+
+    Returns a dict like {'thumb': {'width': 640, 'height': 480, 'webp': 'Dan/x.thumb.3f2a9c01b7de.webp'}}
+    suitable for storing as JSON in the photo table.
+    """
+    # Derivatives carry no EXIF, so bake the camera orientation into the pixels
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+
+    derivatives = {}
+    for size_name, max_edge in sorted(DERIVATIVE_SIZES.items(), key=lambda item: -item[1]):
+        if size_name in SQUARE_DERIVATIVES:
+            edge = min(max_edge, *image.size)
+            resized = ImageOps.fit(image, (edge, edge), Image.Resampling.LANCZOS)
+        else:
+            resized = image.copy()
+            resized.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        entry = {'width': resized.width, 'height': resized.height}
+        for fmt in formats:
+            buffer = io.BytesIO()
+            resized.save(buffer, **ENCODE_OPTIONS[fmt])
+            encoded = buffer.getvalue()
+            path = derivative_path(relative_path, size_name, fmt, hashlib.sha256(encoded).hexdigest())
+            full_path = os.path.join(output_root, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'wb') as f:
+                f.write(encoded)
+            _remove_stale(output_root, relative_path, size_name, fmt, full_path)
+            entry[fmt] = path
+        derivatives[size_name] = entry
+        # Each smaller size is resampled from the previous one rather than the original
+        if size_name not in SQUARE_DERIVATIVES:
+            image = resized
+    return derivatives
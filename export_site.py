@@ -0,0 +1,251 @@
+"""Export the gallery as a static site that a CDN can serve without Python.
+
+    python export_site.py site/
+
+writes the pages and everything they load into site/:
+
+- index.html and about/index.html, rendered from the same templates as app.py
+- data/catalog-<n>.<hash>.json: the catalog in shards of SHARD_SIZE photo ids
+- data/clusters-<zoom>.<hash>.json: every map cluster at each zoom level
+- data/facets[-<n>].<hash>.json: what /api/facets returns, for all photos
+  and for each location
+- static/photos/: the derivatives and Deep Zoom tiles (already
+  content-hashed) and the originals, renamed to <name>.<hash>.<ext>
+- static/: other assets the templates reference through asset_url()
+
+Every file except the two pages has a content hash in its name, so it can be
+cached as immutable; serve the pages with revalidation. Runs are incremental:
+a shard or cluster file is only written when its photos changed, images are
+only copied when missing, and files no longer referenced are deleted. Search
+runs in the browser over the catalog, since there is no /api/search.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import jinja2
+from catalog import PhotoCatalog, CATALOG_FIELDS, to_json_photo
+from deep_zoom import pyramid_files
+from derivatives import HASH_LENGTH
+from facets import query_facets
+from map_clusters import MAX_CLUSTER_ZOOM
+
+# Photos per catalog shard, by id; an ingest usually only touches the last one
+SHARD_SIZE = 1000
+
+CLUSTER_FIELDS = ('count', 'latitude', 'longitude', 'photo_id', 'bounds')
+
+MANIFEST_NAME = '.export-manifest.json'
+
+def content_name(path, body):
+    """'data/catalog-0.json' -> 'data/catalog-0.<hash>.json'"""
+    stem, extension = os.path.splitext(path)
+    return f"{stem}.{hashlib.sha256(body).hexdigest()[:HASH_LENGTH]}{extension}"
+
+def compact_json(value):
+    return json.dumps(value, separators=(',', ':')).encode()
+
+class SiteExport:
+    def __init__(self, output_dir, static_dir='static', templates_dir='templates'):
+        self.output_dir = output_dir
+        self.static_dir = static_dir
+        self.templates_dir = templates_dir
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self.manifest = self._load_manifest()
+        # Claim the directory before writing anything into it, so a run that fails partway can be resumed
+        self.save_manifest()
+        # Every file this export references, relative to output_dir
+        self.keep = {MANIFEST_NAME}
+        self.written = 0
+        self.copied = 0
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        if os.path.isdir(self.output_dir) and os.listdir(self.output_dir):
+            # Stale files are deleted after each run, so never adopt a directory we didn't create
+            raise SystemExit(f"{self.output_dir} is not empty and wasn't created by export_site.py")
+        return {'originals': {}}
+
+    def write(self, path, body):
+        """Write body to path unless it already holds exactly that content"""
+        self.keep.add(path)
+        full_path = os.path.join(self.output_dir, path)
+        if os.path.exists(full_path):
+            with open(full_path, 'rb') as f:
+                if f.read() == body:
+                    return
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        temporary = full_path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(body)
+        os.replace(temporary, full_path)
+        self.written += 1
+
+    def write_hashed(self, path, body):
+        """Write body under its content-hashed name and return that name as a URL"""
+        path = content_name(path, body)
+        self.keep.add(path)
+        if not os.path.exists(os.path.join(self.output_dir, path)):
+            self.write(path, body)
+        return '/' + path
+
+    def copy(self, source, path):
+        """Copy a file whose name already identifies its content, unless it's there"""
+        self.keep.add(path)
+        full_path = os.path.join(self.output_dir, path)
+        if not os.path.exists(full_path):
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            shutil.copy2(source, full_path)
+            self.copied += 1
+
+    def asset_url(self, path):
+        """Stands in for static_files.asset_url: copies the asset under a hashed name"""
+        source = os.path.join(self.static_dir, path)
+        with open(source, 'rb') as f:
+            target = content_name(os.path.join('static', path), f.read())
+        self.copy(source, target)
+        return '/' + target
+
+    def original_path(self, file_path):
+        """Hashed export name of an original, hashing it only when its size or mtime changed"""
+        source = os.path.join(self.static_dir, 'photos', file_path)
+        stat = os.stat(source)
+        known = self.manifest['originals'].get(file_path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            exported = known[2]
+        else:
+            with open(source, 'rb') as f:
+                digest = hashlib.file_digest(f, 'sha256').hexdigest()
+            stem, extension = os.path.splitext(file_path)
+            exported = f"{stem}.{digest[:HASH_LENGTH]}{extension}"
+            self.manifest['originals'][file_path] = [stat.st_size, stat.st_mtime_ns, exported]
+        self.copy(source, os.path.join('static', 'photos', exported))
+        return exported
+
+    def export_photos(self, photos):
+        """Copy every photo's images and return catalog rows pointing at the exported originals"""
+        rows = []
+        for photo in photos:
+            data = to_json_photo(photo)
+            try:
+                data['file_path'] = self.original_path(photo['file_path'])
+            except FileNotFoundError:
+                print(f"Skipping {photo['file_path']}: not found in {self.static_dir}/photos")
+                continue
+            for entry in (photo['derivatives'] or {}).values():
+                for key, value in entry.items():
+                    if isinstance(value, str):
+                        self.copy(os.path.join(self.static_dir, 'photos', value),
+                                  os.path.join('static', 'photos', value))
+            if photo.get('deep_zoom'):
+                try:
+                    tiles = list(pyramid_files(photo['deep_zoom'], os.path.join(self.static_dir, 'photos')))
+                except FileNotFoundError:
+                    print(f"Exporting {photo['file_path']} without zoom tiles: they're missing")
+                    data['deep_zoom'] = None
+                    tiles = []
+                for path in tiles:
+                    self.copy(os.path.join(self.static_dir, 'photos', path), os.path.join('static', 'photos', path))
+            rows.append(data)
+        return rows
+
+    def export_catalog(self, snapshot):
+        """Write the catalog shards and return their URLs"""
+        shards = {}
+        for data in self.export_photos(snapshot.sorted['date-asc']):
+            shards.setdefault(data['id'] // SHARD_SIZE, []).append([data[field] for field in CATALOG_FIELDS])
+        return [
+            self.write_hashed(f'data/catalog-{shard}.json', compact_json({'fields': CATALOG_FIELDS, 'rows': rows}))
+            for shard, rows in sorted(shards.items())
+        ]
+
+    def export_clusters(self, db_path):
+        """Write one cluster file per zoom level and return {zoom: URL}"""
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        try:
+            urls = {}
+            for zoom in range(MAX_CLUSTER_ZOOM + 1):
+                rows = [
+                    [count, latitude, longitude, photo_id, [[min_lat, min_lon], [max_lat, max_lon]]]
+                    for count, latitude, longitude, photo_id, min_lat, min_lon, max_lat, max_lon in conn.execute('''
+                        SELECT count, latitude, longitude, photo_id,
+                               min_latitude, min_longitude, max_latitude, max_longitude
+                        FROM map_cluster WHERE zoom = ? ORDER BY id
+                    ''', (zoom,))
+                ]
+                body = compact_json({'zoom': zoom, 'fields': CLUSTER_FIELDS, 'rows': rows})
+                urls[zoom] = self.write_hashed(f'data/clusters-{zoom}.json', body)
+            return urls
+        finally:
+            conn.close()
+
+    def export_facets(self, db_path):
+        """Write the unfiltered facets and one file per location; return {'all': URL, 'locations': {name: URL}}"""
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            everything = query_facets(conn)
+            urls = {'all': self.write_hashed('data/facets.json', compact_json(everything)), 'locations': {}}
+            for index, (location, _) in enumerate(everything['locations']):
+                body = compact_json(query_facets(conn, location))
+                urls['locations'][location] = self.write_hashed(f'data/facets-{index}.json', body)
+            return urls
+        finally:
+            conn.close()
+
+    def export_pages(self, site):
+        environment = jinja2.Environment(loader=jinja2.FileSystemLoader(self.templates_dir), autoescape=True)
+        environment.globals['asset_url'] = self.asset_url
+        # /about is a directory index so the existing links work on any static host
+        for template, path in (('index.html', 'index.html'), ('about.html', 'about/index.html')):
+            self.write(path, environment.get_template(template).render(site=site).encode())
+
+    def remove_stale(self):
+        removed = 0
+        for directory, _, files in os.walk(self.output_dir, topdown=False):
+            for filename in files:
+                path = os.path.relpath(os.path.join(directory, filename), self.output_dir)
+                if path not in self.keep:
+                    os.remove(os.path.join(directory, filename))
+                    removed += 1
+            if directory != self.output_dir and not os.listdir(directory):
+                os.rmdir(directory)
+        return removed
+
+    def save_manifest(self, exported_paths=None):
+        if exported_paths is not None:
+            # Forget originals that are no longer in the catalog
+            self.manifest['originals'] = {
+                path: entry for path, entry in self.manifest['originals'].items() if path in exported_paths
+            }
+        os.makedirs(self.output_dir, exist_ok=True)
+        temporary = self.manifest_path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(temporary, self.manifest_path)
+
+def export_site(output_dir, db_path='photos.db'):
+    snapshot = PhotoCatalog(db_path).get()
+    export = SiteExport(output_dir)
+    site = {
+        'catalog': export.export_catalog(snapshot),
+        'clusters': export.export_clusters(db_path),
+        'facets': export.export_facets(db_path),
+        'search': None,
+    }
+    export.export_pages(site)
+    removed = export.remove_stale()
+    export.save_manifest({photo['file_path'] for photo in snapshot.photos})
+    print(f"Exported {len(snapshot.photos)} photos to {output_dir}: {export.written} files written, "
+          f"{export.copied} images copied, {removed} stale files removed")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('output_dir', help='directory to write the site to; reuse it for incremental exports')
+    parser.add_argument('--db', default='photos.db', help='database to export')
+    args = parser.parse_args()
+    export_site(args.output_dir, args.db)
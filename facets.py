@@ -0,0 +1,100 @@
+"""Precomputed photo counts for the timeline and the location filter.
+
+photo_facet holds one row per (location_name, hour of taken_at) with the
+number of photos and the first and last capture time in it. It is rebuilt
+with a GROUP BY after ingest, like the map clusters, and stays tiny next to
+the photo table (a two-week trip is a few hundred rows), so every facet the
+page shows is one scan of it: counts per day, per hour and per location,
+and when the photos start and end, for the whole collection or within a
+location or date range.
+"""
+import sqlite3
+from datetime import date, datetime
+from metrics import metrics
+
+def create_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS photo_facet (
+            location_name TEXT,
+            hour TEXT,
+            count INTEGER NOT NULL,
+            first_taken_at TEXT,
+            last_taken_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_photo_facet_hour ON photo_facet (hour)')
+
+def build_facets(cursor):
+    """Recompute photo_facet from the photo table"""
+    cursor.execute('DELETE FROM photo_facet')
+    # taken_at is ISO 8601, so its first 13 characters are the hour: '2024-10-21T14'
+    cursor.execute('''
+        INSERT INTO photo_facet (location_name, hour, count, first_taken_at, last_taken_at)
+        SELECT location_name, substr(taken_at, 1, 13), COUNT(*), MIN(taken_at), MAX(taken_at)
+        FROM photo
+        GROUP BY location_name, substr(taken_at, 1, 13)
+    ''')
+
+def rebuild_facets(db_path='photos.db'):
+    conn = sqlite3.connect(db_path)
+    with conn, metrics.timer('step_seconds', step='rebuild_facets'):
+        build_facets(conn.cursor())
+    count = conn.execute('SELECT COUNT(*) FROM photo_facet').fetchone()[0]
+    conn.close()
+    print(f"Rebuilt photo facets ({count} location/hour rows)")
+
+def hour_bound(value, end=False):
+    """'2024-10-21' or '2024-10-21T14:30' -> the hour key it starts (or, with end=True, ends) in"""
+    if len(value) == 10:
+        day = date.fromisoformat(value).isoformat()
+        return f'{day}T23' if end else f'{day}T00'
+    return datetime.fromisoformat(value).isoformat()[:13]
+
+def query_facets(conn, location=None, start=None, end=None):
+    """Counts by day, hour and location, plus the first and last capture time.
+
+    `location` (exact) and the `start`/`end` hour keys (inclusive) narrow
+    everything except the location counts, which ignore `location` so the
+    filter can still offer the other places.
+    """
+    def where(with_location):
+        clauses, params = [], []
+        if with_location and location is not None:
+            clauses.append('location_name = ?')
+            params.append(location)
+        if start is not None:
+            clauses.append('hour >= ?')
+            params.append(start)
+        if end is not None:
+            clauses.append('hour <= ?')
+            params.append(end)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    filtered, params = where(True)
+    hours = conn.execute(f'''
+        SELECT hour, SUM(count) AS count FROM photo_facet{filtered}
+        GROUP BY hour ORDER BY hour IS NULL, hour
+    ''', params).fetchall()
+    summary = conn.execute(
+        f'SELECT MIN(first_taken_at) AS first, MAX(last_taken_at) AS last FROM photo_facet{filtered}', params
+    ).fetchone()
+    unfiltered, params = where(False)
+    locations = conn.execute(f'''
+        SELECT location_name, SUM(count) AS count FROM photo_facet{unfiltered}
+        GROUP BY location_name ORDER BY location_name IS NULL, location_name
+    ''', params).fetchall()
+
+    days = {}
+    for row in hours:
+        if row['hour'] is not None:
+            day = row['hour'][:10]
+            days[day] = days.get(day, 0) + row['count']
+    return {
+        'total': sum(row['count'] for row in hours),
+        'undated': sum(row['count'] for row in hours if row['hour'] is None),
+        'first': summary['first'],
+        'last': summary['last'],
+        'days': [[day, count] for day, count in days.items()],
+        'hours': [[row['hour'], row['count']] for row in hours if row['hour'] is not None],
+        'locations': [[row['location_name'], row['count']] for row in locations if row['location_name']],
+    }
@@ -0,0 +1,108 @@
+import sqlite3
+import threading
+import time
+from metrics import metrics
+
+# get() default that tells a miss apart from a cached None
+_MISSING = object()
+
+class GeoCache:
+    """SQLite-backed cache for reverse-geocode results and map images.
+
+    Entries are keyed by kind ('geocode', 'map') and the coordinates rounded to
+    `precision` decimal places, so a burst of photos taken within metres of each
+    other shares one external lookup. Concurrent lookups for the same key wait
+    on each other instead of all going to the network.
+    """
+    def __init__(self, path='geo_cache.db', ttl_days=90):
+        self.path = path
+        self.ttl = ttl_days * 86400 if ttl_days else None
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.stats = {}
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS geo_cache (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        ''')
+        self.conn.commit()
+        self.evict_expired()
+
+    @staticmethod
+    def make_key(lat, lon, precision):
+        return f"{round(lat, precision):.{precision}f},{round(lon, precision):.{precision}f}"
+
+    def evict_expired(self):
+        """Delete entries older than the TTL and return how many were removed"""
+        if self.ttl is None:
+            return 0
+        with self.lock:
+            cursor = self.conn.execute(
+                'DELETE FROM geo_cache WHERE created_at < ?', (time.time() - self.ttl,)
+            )
+            self.conn.commit()
+        if cursor.rowcount:
+            print(f"Evicted {cursor.rowcount} expired geo cache entries")
+        return cursor.rowcount
+
+    def _count(self, kind, outcome):
+        metrics.count('cache_requests_total', cache=kind, outcome={'hits': 'hit', 'misses': 'miss'}[outcome])
+        with self.lock:
+            counts = self.stats.setdefault(kind, {'hits': 0, 'misses': 0})
+            counts[outcome] += 1
+
+    def get(self, kind, key, default=None):
+        """The cached value, or `default` if there is none or it has expired"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value, created_at FROM geo_cache WHERE kind = ? AND key = ?', (kind, key)
+            ).fetchone()
+        if row is None or (self.ttl is not None and row[1] < time.time() - self.ttl):
+            return default
+        return row[0]
+
+    def put(self, kind, key, value):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO geo_cache (kind, key, value, created_at) VALUES (?, ?, ?, ?)',
+                (kind, key, value, time.time())
+            )
+            self.conn.commit()
+
+    def get_or_fetch(self, kind, key, fetch, is_valid=None, cache_none=False):
+        """Return the cached value for key, calling fetch() at most once per key on a miss.
+
+        None results are not cached so transient API failures get retried next
+        time, unless `cache_none` is set: then None is a real answer (a spot
+        with no place name) kept for the TTL like any other, and fetch() must
+        raise on failures instead, which leaves nothing cached.
+        `is_valid(value)` can reject a stale hit, e.g. a map file that was deleted.
+        """
+        with self.lock:
+            key_lock = self.key_locks.setdefault((kind, key), threading.Lock())
+        with key_lock:
+            value = self.get(kind, key, _MISSING)
+            if value is not _MISSING and (value is not None or cache_none) and (
+                    is_valid is None or is_valid(value)):
+                self._count(kind, 'hits')
+                return value
+            self._count(kind, 'misses')
+            value = fetch()
+            if value is not None or cache_none:
+                self.put(kind, key, value)
+            return value
+
+    def report(self):
+        for kind, counts in sorted(self.stats.items()):
+            total = counts['hits'] + counts['misses']
+            rate = counts['hits'] / total * 100 if total else 0
+            print(f"Geo cache [{kind}]: {counts['hits']} hits, {counts['misses']} misses ({rate:.0f}% hit rate)")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,182 @@
+"""Per-request metrics and an opt-in sampling profiler for the web app.
+
+RequestMetricsMiddleware records, per route template ('/api/photos', not the
+full URL), the request latency, the response size after compression and the
+time spent in each phase of handling it: SQLite queries, loading the catalog
+snapshot, Jinja rendering, JSON serialization and compression. Code marks a
+phase with
+
+    with phase('render'):
+        ...
+
+and `/metrics` serves everything in the Prometheus text format. Figures are
+per process; with several uvicorn workers each one reports its own.
+
+With PROFILE_REQUESTS=1 in the environment, adding `?profile=1` to any URL
+runs that request under a sampling profiler and returns the samples in the
+collapsed-stack format read by flamegraph.pl, inferno and speedscope instead
+of the normal response. Never enable it on a public deployment.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import parse_qs
+from metrics import Metrics, HELP
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+HELP.update({
+    'http_requests_total': 'Requests handled, by route, method and status',
+    'http_request_seconds': 'Time from receiving a request to sending the last byte of its response',
+    'http_phase_seconds': 'Time spent in each phase of handling a request',
+    'http_response_bytes': 'Response body size as sent, after compression',
+})
+
+# Quantiles in request_metrics cover the last few thousand requests of each series
+request_metrics = Metrics(buckets=LATENCY_BUCKETS, max_samples=2048)
+
+PROFILING_ENABLED = os.environ.get('PROFILE_REQUESTS', '').lower() in ('1', 'true', 'yes')
+PROFILE_INTERVAL = 0.001
+
+# Phase durations of the request being handled; run_in_threadpool copies the
+# context into worker threads, so phases timed there land in the same dict
+_phases = ContextVar('phases', default=None)
+
+@contextmanager
+def phase(name):
+    """Add the time spent in this block to the current request's `name` phase"""
+    phases = _phases.get()
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+def route_name(scope):
+    """Route template for labels, so /api/photos?cursor=... doesn't make a new series per URL"""
+    route = scope.get('route')
+    if route is not None and hasattr(route, 'path'):
+        return route.path
+    if scope.get('root_path', '') and scope.get('app_root_path') is not None:
+        # Inside a Mount such as /static
+        return scope['root_path'][len(scope['app_root_path']):] or 'mount'
+    return 'unmatched'
+
+class RequestMetricsMiddleware:
+    def __init__(self, app, metrics=request_metrics, profiling=PROFILING_ENABLED):
+        self.app = app
+        self.metrics = metrics
+        self.profiling = profiling
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        if self.profiling and parse_qs(scope.get('query_string', b'').decode()).get('profile') == ['1']:
+            await self.profile(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        phases = {}
+        token = _phases.set(phases)
+        status = 500
+        size = 0
+
+        async def send_counted(message):
+            nonlocal status, size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_counted)
+        finally:
+            _phases.reset(token)
+            elapsed = time.perf_counter() - start
+            route = route_name(scope)
+            self.metrics.count('http_requests_total', route=route, method=scope['method'], status=status)
+            self.metrics.observe('http_request_seconds', elapsed, route=route, method=scope['method'])
+            self.metrics.observe('http_response_bytes', size, buckets=SIZE_BUCKETS, route=route)
+            for name, seconds in phases.items():
+                self.metrics.observe('http_phase_seconds', seconds, route=route, phase=name)
+
+    async def profile(self, scope, receive, send):
+        """Run the request under the profiler and answer with its collapsed stacks"""
+        async def discard(message):
+            pass
+
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            profiler.stop()
+        body = profiler.collapsed().encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/plain; charset=utf-8'),
+                (b'content-length', str(len(body)).encode()),
+                (b'x-profile-samples', str(profiler.samples).encode()),
+                (b'cache-control', b'no-store'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+# Leaf frames of threads that are parked, not working; their samples are dropped
+_IDLE_FRAMES = {
+    ('threading.py', 'wait'), ('selectors.py', 'select'), ('queue.py', 'get'),
+    ('thread.py', '_worker'), ('base_events.py', '_run_once'),
+}
+
+class SamplingProfiler:
+    """Samples the stacks of every busy thread about once a millisecond.
+
+    Pure Python, so the overhead is small but real; it profiles one request
+    at a time, which is what ?profile=1 needs.
+    """
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """'outer;inner count' lines, one per distinct stack"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
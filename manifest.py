@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import dataclass, field
+from derivatives import ENCODE_OPTIONS, register_heif
+
+# iPhone photos are HEIC; they are only picked up when Pillow can decode them
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png') + (('.heic', '.heif') if register_heif() else ())
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+@dataclass
+class ScanResult:
+    """What changed in photos/ since the last ingest"""
+    new: list = field(default_factory=list)        # records to run through the pipeline
+    moved: list = field(default_factory=list)      # (old_relative_path, record)
+    unchanged: int = 0
+    adopted: int = 0
+
+def _walk(root):
+    """Yield (DirEntry, relative_path, photographer) for every image below root"""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    relative_path = os.path.relpath(entry.path, root)
+                    yield entry, relative_path, os.path.basename(directory)
+
+def scan(conn, root='photos', skip=()):
+    """Compare photos/ against file_manifest in a single directory walk.
+
+    Files whose size and mtime match the manifest are not read at all. Anything
+    else is hashed: unchanged content only refreshes the manifest, content that
+    disappeared from another path is a move, and the rest is new or edited and
+    goes through the pipeline. Photos ingested before the manifest existed are
+    hashed once and adopted without reprocessing.
+    """
+    manifest = {
+        relative_path: (content_hash, size, mtime_ns)
+        for relative_path, content_hash, size, mtime_ns in conn.execute(
+            'SELECT relative_path, content_hash, size, mtime_ns FROM file_manifest'
+        )
+    }
+    result = ScanResult()
+    seen = set()
+    candidates = []
+    refreshed = []
+    for entry, relative_path, photographer in _walk(root):
+        seen.add(relative_path)
+        if relative_path in skip:
+            continue
+        stat = entry.stat()
+        known = manifest.get(relative_path)
+        if known and known[1] == stat.st_size and known[2] == stat.st_mtime_ns:
+            result.unchanged += 1
+            continue
+        content_hash = hash_file(entry.path)
+        record = {
+            'absolute_path': entry.path,
+            'relative_path': relative_path,
+            'filename': entry.name,
+            'photographer': photographer,
+            'content_hash': content_hash,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+        if known and known[0] == content_hash:
+            # Touched but not modified
+            refreshed.append(record)
+            result.unchanged += 1
+        elif known:
+            record['replaces'] = True
+            candidates.append(record)
+        elif conn.execute('SELECT 1 FROM photo WHERE file_path = ?', (relative_path,)).fetchone():
+            refreshed.append(record)
+            result.adopted += 1
+        else:
+            candidates.append(record)
+
+    # Content that vanished from its old path and turned up at a new one
+    gone = {}
+    for relative_path, (content_hash, _, _) in manifest.items():
+        if relative_path not in seen:
+            gone.setdefault(content_hash, []).append(relative_path)
+    for record in candidates:
+        old_paths = gone.get(record['content_hash'])
+        if old_paths and not record.get('replaces'):
+            result.moved.append((old_paths.pop(), record))
+        else:
+            result.new.append(record)
+
+    with conn:
+        conn.executemany(_UPSERT, [_manifest_row(record) for record in refreshed])
+    return result
+
+_UPSERT = '''
+    INSERT INTO file_manifest (relative_path, content_hash, size, mtime_ns)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (relative_path) DO UPDATE SET
+        content_hash = excluded.content_hash,
+        size = excluded.size,
+        mtime_ns = excluded.mtime_ns
+'''
+
+def _manifest_row(record):
+    return (record['relative_path'], record['content_hash'], record['size'], record['mtime_ns'])
+
+def update_manifest(cursor, record):
+    """Record the file a photo row was built from (used by the database writer)"""
+    cursor.execute(_UPSERT, _manifest_row(record))
+
+def _move_file(old, new):
+    if os.path.exists(old):
+        os.makedirs(os.path.dirname(new), exist_ok=True)
+        if os.path.isdir(new):
+            # The same tiles are already there
+            shutil.rmtree(old)
+        else:
+            os.replace(old, new)
+
+def apply_moves(conn, moves, static_root='static/photos'):
+    """Point existing photo rows at their new paths instead of captioning them again.
+
+    The copy in static/photos, its derivatives and its tile pyramid are
+    renamed to match. The caption keeps the photographer it was written for, but the photographer
+    column follows the new directory.
+    """
+    for old_path, record in moves:
+        new_path = record['relative_path']
+        row = conn.execute('SELECT id, derivatives, deep_zoom FROM photo WHERE file_path = ?',
+                           (old_path,)).fetchone()
+        if row is None:
+            continue
+        photo_id, derivatives, deep_zoom = row
+        derivatives = json.loads(derivatives) if derivatives else None
+        _move_file(os.path.join(static_root, old_path), os.path.join(static_root, new_path))
+        old_stem, new_stem = os.path.splitext(old_path)[0], os.path.splitext(new_path)[0]
+        for entry in (derivatives or {}).values():
+            for fmt in ENCODE_OPTIONS:
+                if entry.get(fmt):
+                    # Same content, so keep the '.size.hash.fmt' suffix and swap the stem
+                    moved = new_stem + entry[fmt][len(old_stem):]
+                    _move_file(os.path.join(static_root, entry[fmt]), os.path.join(static_root, moved))
+                    entry[fmt] = moved
+        if deep_zoom:
+            # '<stem>.<hash>.dzi' and its '<stem>.<hash>_files' tiles, likewise
+            moved = new_stem + deep_zoom[len(old_stem):]
+            _move_file(os.path.join(static_root, deep_zoom), os.path.join(static_root, moved))
+            _move_file(os.path.join(static_root, deep_zoom[:-len('.dzi')] + '_files'),
+                       os.path.join(static_root, moved[:-len('.dzi')] + '_files'))
+            deep_zoom = moved
+        with conn:
+            conn.execute(
+                'UPDATE photo SET file_path = ?, photographer = ?, derivatives = ?, deep_zoom = ? WHERE id = ?',
+                (new_path, record['photographer'], json.dumps(derivatives) if derivatives else None,
+                 deep_zoom, photo_id)
+            )
+            conn.execute('DELETE FROM file_manifest WHERE relative_path = ?', (old_path,))
+            conn.execute(_UPSERT, _manifest_row(record))
+        print(f"Moved {old_path} -> {new_path}")
@@ -0,0 +1,105 @@
+"""Precomputed map clusters, so the page only loads what is in view.
+
+Every photo with coordinates gets a quadkey: the path of Web Mercator tiles
+down to CELL_LEVEL, one digit per zoom. A cluster at map zoom z is every
+photo sharing the first z + CELL_ZOOM_OFFSET digits, i.e. a cell of roughly
+64x64 screen pixels, close to what Leaflet.markercluster used to do on the
+client. Clusters for all zooms are rebuilt with a GROUP BY after ingest and
+indexed in an R*Tree on (zoom, lon, lat) for bbox queries.
+"""
+import math
+import sqlite3
+from metrics import metrics
+
+MAX_CLUSTER_ZOOM = 18
+# 4x4 cells per 256px tile
+CELL_ZOOM_OFFSET = 2
+CELL_LEVEL = MAX_CLUSTER_ZOOM + CELL_ZOOM_OFFSET
+MAX_MERCATOR_LAT = 85.05112878
+
+def photo_quadkey(lat, lon, level=CELL_LEVEL):
+    """Quadkey of the Web Mercator cell containing (lat, lon), or None without coordinates"""
+    if lat is None or lon is None:
+        return None
+    n = 1 << level
+    lat = max(min(lat, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT)
+    sin_lat = math.sin(math.radians(lat))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * n)
+    x, y = min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+    digits = []
+    for bit in range(level - 1, -1, -1):
+        digits.append(str(((x >> bit) & 1) + 2 * ((y >> bit) & 1)))
+    return ''.join(digits)
+
+def create_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS map_cluster (
+            id INTEGER PRIMARY KEY,
+            zoom INTEGER NOT NULL,
+            cell TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            photo_id INTEGER NOT NULL,
+            min_latitude REAL NOT NULL,
+            min_longitude REAL NOT NULL,
+            max_latitude REAL NOT NULL,
+            max_longitude REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS map_cluster_index USING rtree(
+            id, min_zoom, max_zoom, min_longitude, max_longitude, min_latitude, max_latitude
+        )
+    ''')
+
+def build_clusters(cursor):
+    """Recompute every zoom level's clusters from photo.quadkey"""
+    cursor.execute('DELETE FROM map_cluster')
+    cursor.execute('DELETE FROM map_cluster_index')
+    for zoom in range(MAX_CLUSTER_ZOOM + 1):
+        # The earliest photo in each cell stands in for it on the map
+        cursor.execute('''
+            INSERT INTO map_cluster (
+                zoom, cell, count, latitude, longitude, photo_id,
+                min_latitude, min_longitude, max_latitude, max_longitude
+            )
+            SELECT ?, substr(quadkey, 1, ?), COUNT(*), AVG(latitude), AVG(longitude), MIN(id),
+                   MIN(latitude), MIN(longitude), MAX(latitude), MAX(longitude)
+            FROM photo
+            WHERE quadkey IS NOT NULL
+            GROUP BY substr(quadkey, 1, ?)
+        ''', (zoom, zoom + CELL_ZOOM_OFFSET, zoom + CELL_ZOOM_OFFSET))
+    cursor.execute('''
+        INSERT INTO map_cluster_index
+        SELECT id, zoom, zoom, longitude, longitude, latitude, latitude FROM map_cluster
+    ''')
+
+def rebuild_clusters(db_path='photos.db'):
+    conn = sqlite3.connect(db_path)
+    with conn, metrics.timer('step_seconds', step='rebuild_clusters'):
+        build_clusters(conn.cursor())
+    count = conn.execute('SELECT COUNT(*) FROM map_cluster WHERE zoom = ?', (MAX_CLUSTER_ZOOM,)).fetchone()[0]
+    conn.close()
+    print(f"Rebuilt map clusters ({count} at the deepest zoom)")
+
+def query_clusters(conn, zoom, west, south, east, north):
+    """Clusters at `zoom` whose centroid is inside the bbox, with the representative photo's columns"""
+    zoom = min(max(int(zoom), 0), MAX_CLUSTER_ZOOM)
+    # A bbox across the antimeridian arrives with west > east; split it in two
+    ranges = [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+    clusters = []
+    for range_west, range_east in ranges:
+        clusters += conn.execute('''
+            SELECT c.id, c.count, c.latitude, c.longitude, c.photo_id,
+                   c.min_latitude, c.min_longitude, c.max_latitude, c.max_longitude,
+                   p.file_path, p.derivatives
+            FROM map_cluster_index r
+            JOIN map_cluster c ON c.id = r.id
+            LEFT JOIN photo p ON p.id = c.photo_id
+            WHERE r.min_zoom <= ? AND r.max_zoom >= ?
+              AND r.max_longitude >= ? AND r.min_longitude <= ?
+              AND r.max_latitude >= ? AND r.min_latitude <= ?
+        ''', (zoom, zoom, range_west, range_east, south, north)).fetchall()
+    return zoom, clusters
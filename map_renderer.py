@@ -0,0 +1,138 @@
+"""Static map images rendered from a local MBTiles archive, without the network.
+
+    python map_renderer.py osm-japan.mbtiles 35.0116 135.7681 map.jpg
+
+An .mbtiles file is an SQLite database of raster map tiles (PNG, JPEG or
+WebP) in the TMS row order. render() stitches the tiles around a coordinate
+into one image and draws a marker on the spot, giving the captioner the same
+kind of map the SerpAPI lookup did. Decoded tiles stay in an LRU cache, so
+photos taken near each other are drawn from tiles already in memory.
+"""
+import argparse
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image, ImageDraw
+from metrics import metrics
+
+MAP_SIZE = (640, 480)
+MAP_ZOOM = 15  # streets and landmarks, a couple of km across at MAP_SIZE
+TILE_CACHE_SIZE = 256  # decoded tiles, ~256 KB each at 256x256 RGB
+
+BACKGROUND = (230, 230, 230)  # where the archive has no tile
+MARKER_COLOR = (220, 40, 40)
+
+class MBTilesRenderer:
+    """Composes map images from an MBTiles archive; safe to share between worker threads"""
+    def __init__(self, path, zoom=MAP_ZOOM, size=MAP_SIZE, cache_size=TILE_CACHE_SIZE):
+        self.path = path
+        self.size = size
+        self.cache_size = cache_size
+        self.conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()  # (zoom, x, y) -> decoded tile, or None if the archive has none
+        metadata = dict(self.conn.execute('SELECT name, value FROM metadata'))
+        if metadata.get('format', 'png') not in ('png', 'jpg', 'jpeg', 'webp'):
+            raise ValueError(f"{path} holds {metadata['format']} tiles; only raster tiles can be rendered")
+        self.attribution = metadata.get('attribution')
+        self.zooms = [row[0] for row in self.conn.execute('SELECT DISTINCT zoom_level FROM tiles ORDER BY 1')]
+        if not self.zooms:
+            raise ValueError(f"{path} has no tiles")
+        # The closest zoom the archive has at or below the one asked for
+        self.zoom = max((z for z in self.zooms if z <= zoom), default=self.zooms[0])
+        sample = self.conn.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? LIMIT 1',
+                                   (self.zoom,)).fetchone()[0]
+        self.tile_size = Image.open(BytesIO(sample)).width  # 256, or 512 for "retina" tiles
+
+    def _tile(self, zoom, x, y):
+        """Decoded tile at XYZ position (x, y), or None if the archive doesn't have it"""
+        key = (zoom, x, y)
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                metrics.count('cache_requests_total', cache='tiles', outcome='hit')
+                return self.tiles[key]
+            # MBTiles rows count from the bottom (TMS), XYZ tiles from the top
+            row = self.conn.execute(
+                'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                (zoom, x, (1 << zoom) - 1 - y)
+            ).fetchone()
+        metrics.count('cache_requests_total', cache='tiles', outcome='miss')
+        tile = None
+        if row is not None:
+            # Decoding is the slow part, so it happens outside the lock
+            tile = Image.open(BytesIO(row[0])).convert('RGB')
+        with self.lock:
+            self.tiles[key] = tile
+            if len(self.tiles) > self.cache_size:
+                self.tiles.popitem(last=False)
+        return tile
+
+    def pixel(self, lat, lon):
+        """Web Mercator position of (lat, lon) in pixels of the whole world map at self.zoom"""
+        scale = self.tile_size * (1 << self.zoom)
+        lat = max(-85.05112878, min(85.05112878, lat))
+        x = (lon + 180) / 360 * scale
+        sin_lat = math.sin(math.radians(lat))
+        y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+        return x, y
+
+    def render(self, lat, lon):
+        """Map image centred on (lat, lon) with a marker on it"""
+        width, height = self.size
+        center_x, center_y = self.pixel(lat, lon)
+        left, top = center_x - width / 2, center_y - height / 2
+        tiles_across = 1 << self.zoom
+        image = Image.new('RGB', self.size, BACKGROUND)
+        size = self.tile_size
+        for tile_y in range(math.floor(top / size), math.floor((top + height) / size) + 1):
+            if not 0 <= tile_y < tiles_across:
+                continue
+            for tile_x in range(math.floor(left / size), math.floor((left + width) / size) + 1):
+                # Wrap around the antimeridian
+                tile = self._tile(self.zoom, tile_x % tiles_across, tile_y)
+                if tile is not None:
+                    image.paste(tile, (round(tile_x * size - left), round(tile_y * size - top)))
+        draw = ImageDraw.Draw(image)
+        x, y = width / 2, height / 2
+        draw.ellipse((x - 9, y - 9, x + 9, y + 9), fill=MARKER_COLOR, outline='white', width=3)
+        if self.attribution:
+            draw.text((4, height - 14), self.attribution, fill=(60, 60, 60))
+        return image
+
+    def save(self, lat, lon, filename):
+        """Render the map for (lat, lon) to maps/map_<filename>.jpg and return its path"""
+        path = os.path.join('maps', f'map_{filename}.jpg')
+        os.makedirs('maps', exist_ok=True)
+        with metrics.timer('step_seconds', step='map_render'):
+            image = self.render(lat, lon)
+            # Photos sharing a rounded position share the file; never let one see it half written
+            temporary = f'{path}.{threading.get_ident()}.tmp'
+            image.save(temporary, format='JPEG', quality=85)
+            os.replace(temporary, path)
+        return path
+
+    def close(self):
+        self.conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('mbtiles')
+    parser.add_argument('lat', type=float)
+    parser.add_argument('lon', type=float)
+    parser.add_argument('output', nargs='?', default='map.jpg')
+    parser.add_argument('--zoom', type=int, default=MAP_ZOOM)
+    args = parser.parse_args()
+    renderer = MBTilesRenderer(args.mbtiles, args.zoom)
+    started = time.perf_counter()
+    renderer.render(args.lat, args.lon).save(args.output, format='JPEG', quality=85)
+    first = time.perf_counter() - started
+    started = time.perf_counter()
+    renderer.render(args.lat + 0.0005, args.lon + 0.0005)
+    cached = time.perf_counter() - started
+    print(f"Wrote {args.output} at zoom {renderer.zoom} in {first * 1000:.1f} ms "
+          f"({cached * 1000:.1f} ms for a nearby spot with the tiles cached)")
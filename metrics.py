@@ -0,0 +1,258 @@
+"""Counters and timing histograms for an ingest run, written out as a JSON report.
+
+Everything goes through the process-wide `metrics` registry:
+
+    metrics.count('api_calls_total', api='nominatim', status=200)
+    with metrics.timer('step_seconds', step='exif'):
+        ...
+
+Names and labels follow Prometheus conventions, so the same data can also be
+written as a node_exporter textfile. Per-photo figures (token usage) are added
+with add_photo_usage() and attributed to the photo the current pipeline
+worker is handling, set by Stage through photo_context().
+"""
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Upper bounds in seconds, from a fast local step up to a slow, rate limited API call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    'stage_seconds': 'Time spent handling one record in a pipeline stage',
+    'stage_records_total': 'Records handled by a pipeline stage, by outcome',
+    'step_seconds': 'Time spent in one step of local processing or the database writer',
+    'api_seconds': 'Latency of calls to external APIs',
+    'api_calls_total': 'Calls to external APIs, by HTTP status or outcome',
+    'api_retries_total': 'Calls to external APIs that were retried',
+    'api_bytes_sent_total': 'Request bytes sent to external APIs',
+    'api_bytes_received_total': 'Response bytes received from external APIs',
+    'cache_requests_total': 'Geo cache lookups, by hit or miss',
+    'tokens_total': 'Claude tokens used, by kind',
+    'photos_written_total': 'Photos saved to the database',
+    'burst_siblings_total': 'Burst shots that reused the caption of a near-identical photo',
+}
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _quantile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class Histogram:
+    """Observations of one series: Prometheus buckets plus raw values for quantiles.
+
+    With max_samples set, quantiles come from the most recent observations
+    only, so a long-running process doesn't keep every value.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_samples=None):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.values = deque(maxlen=max_samples)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.values.append(value)
+
+    def bucket_counts(self):
+        """Cumulative (upper bound, count) pairs, as Prometheus expects"""
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def summary(self):
+        ordered = sorted(self.values)
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'p50': _quantile(ordered, 0.50),
+            'p95': _quantile(ordered, 0.95),
+            'p99': _quantile(ordered, 0.99),
+            'max': ordered[-1] if ordered else None,
+        }
+
+class Metrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_samples=None):
+        self.buckets = buckets
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Start a new run: drop everything recorded so far"""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.photos = {}
+            self.stage_workers = {}
+            self.started = time.time()
+
+    def count(self, name, amount=1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=None, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets or self.buckets, self.max_samples)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register_stage(self, name, workers):
+        """Remember a stage's pool size, to report how busy its workers were"""
+        with self.lock:
+            self.stage_workers[name] = workers
+
+    @contextmanager
+    def photo_context(self, relative_path):
+        """Attribute add_photo_usage() calls in this thread to one photo"""
+        previous = getattr(self.local, 'photo', None)
+        self.local.photo = relative_path
+        try:
+            yield
+        finally:
+            self.local.photo = previous
+
+    def add_photo_usage(self, relative_path=None, **amounts):
+        relative_path = relative_path or getattr(self.local, 'photo', None)
+        if relative_path is None:
+            return
+        with self.lock:
+            usage = self.photos.setdefault(relative_path, {})
+            for name, amount in amounts.items():
+                usage[name] = usage.get(name, 0) + (amount or 0)
+
+    def stage_utilization(self, elapsed):
+        """Fraction of the run each stage's workers were busy; the busiest is the bottleneck"""
+        busy = {}
+        for (name, labels), histogram in self.histograms.items():
+            if name == 'stage_seconds':
+                stage = dict(labels)['stage']
+                busy[stage] = busy.get(stage, 0.0) + histogram.sum
+        return {
+            stage: round(seconds / (self.stage_workers.get(stage, 1) * elapsed), 4) if elapsed else None
+            for stage, seconds in busy.items()
+        }
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            utilization = self.stage_utilization(elapsed)
+            return {
+                'started_at': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                'elapsed_seconds': round(elapsed, 3),
+                'stage_workers': dict(self.stage_workers),
+                'stage_utilization': utilization,
+                'bottleneck': max(utilization, key=utilization.get) if utilization else None,
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), **histogram.summary()}
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+                'photos': dict(sorted(self.photos.items())),
+            }
+
+    def prometheus_text(self, prefix='photo_ingest_'):
+        """The counters and histograms in the Prometheus text exposition format"""
+        def series(name, labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return prefix + name
+            escaped = ','.join(
+                '{}="{}"'.format(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                for label, value in pairs
+            )
+            return f'{prefix}{name}{{{escaped}}}'
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = [
+                (key, histogram.bucket_counts(), histogram.sum, histogram.count)
+                for key, histogram in sorted(self.histograms.items())
+            ]
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines += [f'# HELP {prefix}{name} {HELP.get(name, name)}', f'# TYPE {prefix}{name} counter']
+            lines.append(f'{series(name, labels)} {value}')
+        for (name, labels), buckets, total, count in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines += [f'# HELP {prefix}{name} {HELP.get(name, name)}', f'# TYPE {prefix}{name} histogram']
+            for bound, cumulative in buckets:
+                lines.append(f'{series(name + "_bucket", labels, [("le", repr(bound))])} {cumulative}')
+            lines.append(f'{series(name + "_bucket", labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{series(name + "_sum", labels)} {total}')
+            lines.append(f'{series(name + "_count", labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, path):
+        _write_atomic(path, json.dumps(self.report(), indent=2))
+        print(f"Wrote run report to {path}")
+
+    def write_prometheus(self, path, prefix='photo_ingest_'):
+        elapsed = time.time() - self.started
+        text = self.prometheus_text(prefix) + '\n'.join([
+            f'# TYPE {prefix}last_run_seconds gauge', f'{prefix}last_run_seconds {elapsed:.3f}',
+            f'# TYPE {prefix}last_run_timestamp_seconds gauge',
+            f'{prefix}last_run_timestamp_seconds {math.floor(time.time())}',
+        ]) + '\n'
+        # node_exporter may read the file at any moment, so replace it in one step
+        _write_atomic(path, text)
+        print(f"Wrote Prometheus metrics to {path}")
+
+    def print_summary(self):
+        """One line per stage: records, time per record and how busy its workers were"""
+        report = self.report()
+        for entry in report['histograms']:
+            if entry['name'] == 'stage_seconds' and entry['count']:
+                stage = entry['labels']['stage']
+                busy = report['stage_utilization'].get(stage)
+                print(f"Stage {stage}: {entry['count']} records, mean {entry['mean']:.3f}s, "
+                      f"p95 {entry['p95']:.3f}s, workers busy {busy or 0:.0%}")
+        if report['bottleneck']:
+            print(f"Busiest stage: {report['bottleneck']}")
+
+def _write_atomic(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+metrics = Metrics()
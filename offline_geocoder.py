@@ -0,0 +1,172 @@
+"""Reverse geocoding from a local GeoNames gazetteer, without the network.
+
+    python offline_geocoder.py gazetteer/cities15000.zip 35.0116 135.7681
+    python offline_geocoder.py gazetteer/cities15000.zip
+
+The first prints the place for one coordinate, the second measures lookups
+per second. Download a cities file (cities15000.zip, or cities500/1000/5000
+for more small towns) and admin1CodesASCII.txt from
+https://download.geonames.org/export/dump/ into one directory; the zip can
+be used as is.
+
+Every city becomes a point on the unit sphere, so distances work across the
+antimeridian and near the poles. The points go into a k-d tree kept in flat
+arrays: a balanced tree needs no node objects, only each range's median at
+its middle, and a lookup visits a few dozen points. Names come back as
+"City, State" like get_location_name() in process_images.py.
+"""
+import argparse
+import io
+import math
+import os
+import random
+import time
+import zipfile
+from array import array
+
+ADMIN1_FILE = 'admin1CodesASCII.txt'
+
+# Further than this from any city counts as nowhere, e.g. out at sea
+MAX_DISTANCE_KM = 100
+
+EARTH_RADIUS_KM = 6371.0
+
+def to_unit_vector(lat, lon):
+    lat, lon = math.radians(lat), math.radians(lon)
+    return math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)
+
+def _open_text(path):
+    """A GeoNames dump, either extracted or as the zip it's downloaded in"""
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        name = next(name for name in archive.namelist() if name.endswith('.txt'))
+        return io.TextIOWrapper(archive.open(name), encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+def read_admin1_names(path):
+    """{'JP.40': 'Tokyo', ...} from admin1CodesASCII.txt"""
+    names = {}
+    with _open_text(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2:
+                names[fields[0]] = fields[1]
+    return names
+
+class OfflineGeocoder:
+    """Nearest-city lookups over a k-d tree of GeoNames cities.
+
+    The tree is implicit: the points of a range [lo, hi) are ordered so that
+    the median along that depth's axis sits at (lo + hi) // 2, with the
+    closer half on each side of it. x, y and z are parallel arrays of unit
+    vectors and labels the "City, State" name for each position.
+    """
+    def __init__(self, points, labels, max_distance_km=MAX_DISTANCE_KM):
+        count = len(labels)
+        xs, ys, zs = (array('d', (point[axis] for point in points)) for axis in range(3))
+        order = list(range(count))
+        axes = (xs, ys, zs)
+        stack = [(0, count, 0)]
+        while stack:
+            lo, hi, axis = stack.pop()
+            if hi - lo < 2:
+                continue
+            order[lo:hi] = sorted(order[lo:hi], key=axes[axis].__getitem__)
+            mid = (lo + hi) // 2
+            following = (axis + 1) % 3
+            stack.append((lo, mid, following))
+            stack.append((mid + 1, hi, following))
+        self.x, self.y, self.z = (array('d', (values[i] for i in order)) for values in axes)
+        self.labels = [labels[i] for i in order]
+        # Squared chord length matching the great-circle distance limit
+        chord = 2 * math.sin(min(max_distance_km / EARTH_RADIUS_KM, math.pi) / 2)
+        self.max_chord_sq = chord * chord + 1e-12
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def load(cls, path, admin1_path=None, max_distance_km=MAX_DISTANCE_KM):
+        """Index a GeoNames cities file; admin1CodesASCII.txt next to it supplies the state names"""
+        started = time.perf_counter()
+        admin1_path = admin1_path or os.path.join(os.path.dirname(path), ADMIN1_FILE)
+        if os.path.exists(admin1_path):
+            admin1 = read_admin1_names(admin1_path)
+        else:
+            print(f"Warning: {admin1_path} not found; places will have no state/prefecture")
+            admin1 = {}
+        points, labels, interned = [], [], {}
+        with _open_text(path) as f:
+            for line in f:
+                fields = line.split('\t')
+                if len(fields) < 11:
+                    continue
+                city = fields[1]
+                state = admin1.get(f'{fields[8]}.{fields[10]}')
+                label = f"{city}, {state}" if state and state != city else city
+                points.append(to_unit_vector(float(fields[4]), float(fields[5])))
+                # Many cities share a state, so share the strings too
+                labels.append(interned.setdefault(label, label))
+        geocoder = cls(points, labels, max_distance_km)
+        print(f"Indexed {len(geocoder)} places from {path} in {time.perf_counter() - started:.1f}s")
+        return geocoder
+
+    def nearest(self, lat, lon):
+        """Tree position of the city closest to (lat, lon), or None if none is within range"""
+        qx, qy, qz = query = to_unit_vector(lat, lon)
+        xs, ys, zs = self.x, self.y, self.z
+        axes = (xs, ys, zs)
+        best, best_position = self.max_chord_sq, None
+        # (lo, hi, axis, squared distance from the query to this range's side of the split)
+        stack = [(0, len(self.labels), 0, 0.0)]
+        while stack:
+            lo, hi, axis, bound = stack.pop()
+            if lo >= hi or bound >= best:
+                continue
+            mid = (lo + hi) // 2
+            dx, dy, dz = xs[mid] - qx, ys[mid] - qy, zs[mid] - qz
+            distance = dx * dx + dy * dy + dz * dz
+            if distance < best:
+                best, best_position = distance, mid
+            split = query[axis] - axes[axis][mid]
+            following = (axis + 1) % 3
+            # Push the far side first so the near side is searched first and tightens `best`
+            if split > 0:
+                stack.append((lo, mid, following, split * split))
+                stack.append((mid + 1, hi, following, 0.0))
+            else:
+                stack.append((mid + 1, hi, following, split * split))
+                stack.append((lo, mid, following, 0.0))
+        return best_position
+
+    def lookup(self, lat, lon):
+        """'City, State' of the nearest city, or None"""
+        position = self.nearest(lat, lon)
+        return None if position is None else self.labels[position]
+
+    def lookup_many(self, coordinates):
+        """lookup() for a sequence of (lat, lon), searching each distinct coordinate once"""
+        found = {}
+        for coordinate in coordinates:
+            if coordinate not in found:
+                found[coordinate] = self.lookup(*coordinate)
+        return [found[coordinate] for coordinate in coordinates]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('gazetteer', help='GeoNames cities file, .txt or .zip')
+    parser.add_argument('coordinates', nargs='*', type=float, metavar='LAT LON')
+    parser.add_argument('--lookups', type=int, default=100000, help='random lookups to time')
+    args = parser.parse_args()
+    geocoder = OfflineGeocoder.load(args.gazetteer)
+    if args.coordinates:
+        pairs = list(zip(args.coordinates[::2], args.coordinates[1::2]))
+        for (lat, lon), name in zip(pairs, geocoder.lookup_many(pairs)):
+            print(f"{lat}, {lon}: {name}")
+    else:
+        rng = random.Random(0)
+        queries = [(rng.uniform(-60, 70), rng.uniform(-180, 180)) for _ in range(args.lookups)]
+        started = time.perf_counter()
+        geocoder.lookup_many(queries)
+        elapsed = time.perf_counter() - started
+        print(f"{len(queries)} lookups in {elapsed:.2f}s ({elapsed / len(queries) * 1e6:.1f} µs each)")
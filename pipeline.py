@@ -0,0 +1,227 @@
+import queue
+import sqlite3
+import threading
+import time
+import json
+import math
+from datetime import datetime
+from manifest import update_manifest
+from map_clusters import photo_quadkey
+from metrics import metrics
+
+_STOP = object()
+
+def _json_value(value):
+    if isinstance(value, dict):
+        return {str(key): _json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_value(item) for item in value]
+    if isinstance(value, bytes):
+        try:
+            return value.decode('ascii').rstrip('\x00')
+        except UnicodeDecodeError:
+            return value.hex()
+    if isinstance(value, (str, int, bool)) or value is None:
+        return value
+    # IFDRational and other numbers; 0/0 rationals come out as NaN
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return number if math.isfinite(number) else None
+
+def exif_json(exif_data):
+    """EXIF tags as a JSON string: rationals become floats, binary values hex"""
+    return json.dumps(_json_value(exif_data or {}))
+
+def exif_datetime_to_iso(value):
+    """'2024:10:21 14:03:00' -> '2024-10-21T14:03:00', or None if unparseable"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value.strip().rstrip('\x00'), '%Y:%m:%d %H:%M:%S').isoformat()
+    except ValueError:
+        return None
+
+class RateLimiter:
+    """Spaces calls out so that no more than `rate` calls per second are started.
+
+    Shared by all workers of a stage, so the limit holds for the stage as a
+    whole no matter how many threads it runs. A rate of None disables limiting.
+    """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+class Stage:
+    """A bounded pool of worker threads that applies `func` to each record.
+
+    `func(record, limiter)` returns the record to hand to the next stage, or
+    None to drop it. Records that raise are reported and dropped so a single
+    bad photo never stalls the run; it will simply be picked up again next time.
+    """
+    def __init__(self, name, func, workers=1, rate=None, queue_size=None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.limiter = RateLimiter(rate)
+        self.queue = queue.Queue(maxsize=queue_size or self.workers * 4)
+        self.next_stage = None
+        self.threads = []
+
+    def then(self, next_stage):
+        self.next_stage = next_stage
+        return next_stage
+
+    def start(self):
+        metrics.register_stage(self.name, self.workers)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, record):
+        self.queue.put(record)
+
+    def close(self):
+        """Wait for queued records to drain, then close the downstream stage"""
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        if self.next_stage is not None:
+            self.next_stage.close()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+            start = time.perf_counter()
+            try:
+                with metrics.photo_context(record.get('relative_path')):
+                    result = self.func(record, self.limiter)
+            except Exception as e:
+                metrics.count('stage_records_total', stage=self.name, outcome='error')
+                print(f"Error in {self.name} stage for {record.get('relative_path')}: {str(e)}")
+                continue
+            finally:
+                metrics.observe('stage_seconds', time.perf_counter() - start, stage=self.name)
+            metrics.count('stage_records_total', stage=self.name, outcome='ok' if result is not None else 'dropped')
+            if result is not None and self.next_stage is not None:
+                self.next_stage.put(result)
+
+class DatabaseWriter:
+    """Single thread that owns the SQLite connection and batches inserts.
+
+    Records are committed every `batch_size` photos or every `flush_interval`
+    seconds, whichever comes first, so worker threads never touch the database.
+    """
+    def __init__(self, db_path='photos.db', batch_size=25, flush_interval=2.0):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self.written = 0
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, record):
+        self.queue.put(record)
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path)
+        batch = []
+        stopping = False
+        try:
+            while not stopping:
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    try:
+                        record = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if record is _STOP:
+                        stopping = True
+                        break
+                    batch.append(record)
+                if batch:
+                    self._write_batch(conn, batch)
+                    batch = []
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn, batch):
+        with metrics.timer('step_seconds', step='sqlite_write'):
+            self._insert_batch(conn, batch)
+
+    def _insert_batch(self, conn, batch):
+        cursor = conn.cursor()
+        try:
+            written = 0
+            for record in batch:
+                if record.get('replaces'):
+                    # An edited file: its new version replaces the old row, and stops representing a burst
+                    cursor.execute('UPDATE photo SET burst_of = NULL WHERE burst_of IN '
+                                   '(SELECT id FROM photo WHERE file_path = ?)', (record['relative_path'],))
+                    cursor.execute('DELETE FROM point_of_interest WHERE photo_id IN '
+                                   '(SELECT id FROM photo WHERE file_path = ?)', (record['relative_path'],))
+                    cursor.execute('DELETE FROM photo WHERE file_path = ?', (record['relative_path'],))
+                exif_data = record['exif_data']
+                cursor.execute('''
+                    INSERT OR IGNORE INTO photo (
+                        file_path, caption, date_taken, taken_at,
+                        latitude, longitude, quadkey, location_name, exif_data, photographer,
+                        derivatives, deep_zoom, dhash, burst_of
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT id FROM photo WHERE file_path = ?))
+                ''', (
+                    record['relative_path'], record['caption'], record['date_taken'],
+                    exif_datetime_to_iso(record['date_taken']),
+                    record['latitude'], record['longitude'],
+                    photo_quadkey(record['latitude'], record['longitude']), record['location_name'],
+                    exif_data if isinstance(exif_data, str) else exif_json(exif_data),
+                    record['photographer'],
+                    json.dumps(record['derivatives']) if record.get('derivatives') else None,
+                    record.get('deep_zoom'), record.get('dhash'), record.get('burst_of')
+                ))
+                if cursor.rowcount == 0:
+                    # file_path is unique; another run already saved this photo
+                    print(f"Skipping {record['relative_path']}: already in the database")
+                    continue
+                written += 1
+                photo_id = cursor.lastrowid
+                points_of_interest = json.loads(record['points_of_interest'])
+                cursor.executemany('''
+                    INSERT INTO point_of_interest (
+                        photo_id, name, description
+                    )
+                    VALUES (?, ?, ?)
+                ''', [(photo_id, poi['name'], poi['description']) for poi in points_of_interest])
+                if record.get('content_hash'):
+                    update_manifest(cursor, record)
+            conn.commit()
+            self.written += written
+            metrics.count('photos_written_total', written)
+            print(f"Saved {written} photos to the database ({self.written} this run)")
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"Error inserting into database: {str(e)}")
@@ -1,31 +1,46 @@
 import os
 import sqlite3
-from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
+from PIL import Image, ImageOps
 import requests
-from anthropic import Anthropic, APIError
 import base64
 from serpapi import GoogleSearch
 import dotenv
 import setup_database
+import manifest
 from io import BytesIO
 import sys
 import shutil
-import instructor
-from pydantic import BaseModel
-from typing import List
 import json
-import time
+import argparse
+from dataclasses import dataclass, fields
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import Stage, DatabaseWriter
+from bursts import BurstGroups, dhash, BURST_DISTANCE, BURST_SECONDS
+from geo_cache import GeoCache
+from offline_geocoder import OfflineGeocoder
+from map_renderer import MBTilesRenderer, MAP_ZOOM
+from metrics import metrics
+from map_clusters import rebuild_clusters
+from facets import rebuild_facets
+from captioning import CAPTION_PROMPT_PATH, check_prompt_caching, generate_caption, load_prompt
+from batch_captions import BatchSubmitter, collect_batches, pending_batch_paths
+from derivatives import generate_derivatives, avif_available, DERIVATIVE_SIZES
+from exif_reader import read_metadata
+from deep_zoom import generate_pyramid
 
 dotenv.load_dotenv()
 
-class PointOfInterest(BaseModel):
-    name: str
-    description: str
+# Overridable so ingest can run against stub_servers.py, e.g. for benchmarks
+NOMINATIM_URL = os.environ.get('NOMINATIM_URL', 'https://nominatim.openstreetmap.org')
+SERPAPI_URL = os.environ.get('SERPAPI_URL', 'https://serpapi.com')
 
-class PhotoAnalysis(BaseModel):
-    caption: str
-    points_of_interest: List[PointOfInterest]
+# One keep-alive connection for every Nominatim lookup of a run
+nominatim_session = requests.Session()
+nominatim_session.headers.update({
+    'User-Agent': 'photo-gallery-ingest',  # Nominatim's usage policy asks for an identifying agent
+    'Accept-Language': 'en',  # Request English names
+})
 
 def ensure_directories():
     """Create necessary directories if they don't exist"""
@@ -34,9 +49,9 @@ def ensure_directories():
         os.makedirs(directory, exist_ok=True)
         print(f"Ensured directory exists: {directory}")
 
-def check_required_env_vars():
+def check_required_env_vars(need_serpapi=True):
     """Check for required env vars and format system prompt if needed"""
-    required_vars = ['ANTHROPIC_API_KEY', 'SERP_API_KEY']
+    required_vars = ['ANTHROPIC_API_KEY', 'SERP_API_KEY'] if need_serpapi else ['ANTHROPIC_API_KEY']
     missing_vars = [var for var in required_vars if var not in os.environ]
     
     if missing_vars:
@@ -48,24 +63,47 @@ def check_required_env_vars():
     
 def get_exif_data(image_path):
     print(f"Extracting EXIF data from {image_path}...")
-    image = Image.open(image_path)
-    exif_data = {}
-    try:
-        info = image._getexif()
-        if info:
-            for tag, value in info.items():
-                tag_name = TAGS.get(tag, tag)
-                if tag_name == 'GPSInfo':
-                    gps_data = {}
-                    for key in value.keys():
-                        decode = GPSTAGS.get(key, key)
-                        gps_data[decode] = value[key]
-                    exif_data['GPSInfo'] = gps_data
-                else:
-                    exif_data[tag_name] = value
-    except AttributeError as e:
-        print(f"Warning: Could not extract EXIF data from {image_path}: {str(e)}")
-    return exif_data
+    return read_metadata(image_path)
+
+@dataclass
+class PreparedImage:
+    """Everything ingest needs from one decode of a photo"""
+    exif_data: dict
+    image: Image.Image  # decoded, upright and no larger than needed; dropped after the local stage
+    model_image_base64: str  # downscaled JPEG sent to Claude
+
+def prepare_image(image_path, model_max_edge=1568, min_edge=None):
+    """Open and decode a photo exactly once.
+
+    Reads EXIF from the file header, then decodes at the smallest size that still
+    covers both the model image and `min_edge` (the largest derivative). For
+    JPEGs, draft() lets libjpeg decode directly at 1/2, 1/4 or 1/8 scale;
+    other formats fall back to a fast integer reduce().
+    """
+    print(f"Preparing image {image_path}...")
+    needed = max(model_max_edge, min_edge or 0)
+    with metrics.timer('step_seconds', step='exif'):
+        exif_data = read_metadata(image_path)
+    with Image.open(image_path) as image:
+        width, height = image.size
+        scale = needed / max(width, height)
+        if scale < 1:
+            image.draft('RGB', (max(1, int(width * scale)), max(1, int(height * scale))))
+        image.load()
+        factor = int(max(image.size) / needed)
+        if factor >= 2:
+            image = image.reduce(factor)
+        image = ImageOps.exif_transpose(image)
+
+    model_image = image.convert('RGB')
+    model_image.thumbnail((model_max_edge, model_max_edge), Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    model_image.save(buffer, format='JPEG', quality=85)
+    return PreparedImage(
+        exif_data=exif_data,
+        image=image,
+        model_image_base64=base64.b64encode(buffer.getvalue()).decode('utf-8'),
+    )
 
 def get_lat_lon(gps_info):
     if not gps_info:
@@ -94,195 +132,49 @@ def get_lat_lon(gps_info):
         print(f"Error converting GPS coordinates: {str(e)}")
         return None, None
 
-def get_processed_files():
-    """Get list of already processed files from database"""
-    conn = sqlite3.connect('photos.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT file_path FROM photo')
-    processed = {row[0] for row in cursor.fetchall()}
-    conn.close()
-    return processed
-
-def generate_caption(image_path, photographer, map_image_path=None, location_name=None):
-    """Modified to include retry logic"""
-    max_retries = 3
-    base_delay = 5  # seconds
-    
-    for attempt in range(max_retries):
-        try:
-            print(f"Generating caption and points of interest for {image_path}...")
-            # Initialize Anthropic client with Instructor
-            anthropic_client = instructor.from_anthropic(
-                Anthropic(api_key=os.environ['ANTHROPIC_API_KEY'])
-            )
-
-            system_prompt = """Don't worry about formalities.
-
-            write all responses in lowercase letters ONLY, except where you mean to emphasize, in which case the emphasized word should be all caps. Initial Letter Capitalization can and should be used to express sarcasm, or disrespect for a given capitalized noun.
-
-            """
-
-            # Get EXIF data for date/time
-            exif_data = get_exif_data(image_path)
-            date_taken = exif_data.get('DateTimeOriginal', 'unknown date/time')
-
-            # Add location context to the instruction text
-            location_context = f" The photo was taken in {location_name}." if location_name else ""
-
-            # Create the instruction text that was previously in system prompt
-            instruction_text = f"""
-            You are creating captions for a travel blog called 'Dan in Japan' about a vacation 
-            taken by two couples in October 2024. Write natural, conversational captions in all 
-            lowercase that avoid clichés and overwrought emotional descriptions.
-
-            You are being given a photo from the trip along with a screenshot of a map showing 
-            where the photo was taken using the serpAPI from the photo coordinates. The items identified in the map are for context only, it doesn't mean that the photo is exactly of something shown in the map.
-
-           The photographer was {photographer} and the date it was taken was {date_taken} at {location_context}.
-
-           If Chuck took the photo, then it's him and his wife Ashley. If Daniel took the photo, then it's him and his wife Christina, and vice-versa.
-
-            Trip details:
-            - First time in Japan
-            - 10 days during second half of October 2024, October 19 through Nov. 1. 
-            - Visited Tokyo, Osaka, and Kyoto
-            - Stayed in:
-            - Tokyo (Airbnb)
-            - Osaka (traditional Japanese house)
-            - Kyoto (western hotel)
-            - Any photos you see taken outside of Tokyo, Osaka, or Kyoto are probably on the bullet train.
-
-            Caption guidelines:
-            - Always identify the people in the photo by name
-            - Write as if texting a friend - casual and genuine
-            - Avoid cliché travel writing phrases like "capturing the moment" or "radiating excitement"
-            - No exclamation points unless absolutely necessary
-            - Skip obvious details (we can see they're smiling/happy/etc)
-            - Keep it to 1-2 short sentences
-            - For US photos (pre/post trip), mention that it's from before/after the Japan trip
-
-            Don't:
-            - Use flowery or emotional language
-            - Describe obvious visual elements
-            - Add fictional details
-            - Assume activities from map locations
-
-            Your Points of Interest should be notable locations, cultural elements, or historical references that warrant further explanation in a modal window. 
-
-            Skip mundane points of interest.
-
-            Each point of interest you generate is going to be clickable and its going to open a google search for the phrase you pick, so choose things that can be googled and are japan related. 
-
-            Here are the images to analyze:
-            """
-
-            print(instruction_text)
-
-            messages_content = [{'type': 'text', 'text': instruction_text}]
-
-            if map_image_path is not None:
-                try:
-                    print("Processing map image...")
-                    with Image.open(map_image_path) as img:
-                        buffer = BytesIO()
-                        img.convert('RGB').save(buffer, format='JPEG')
-                        map_image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                    messages_content.append({
-                        'type': 'image',
-                        'source': {
-                            'type': 'base64',
-                            'media_type': 'image/jpeg',
-                            'data': map_image_base64
-                        }
-                    })
-                except Exception as e:
-                    print(f"Warning: Failed to process map image: {str(e)}")
-
-            try:
-                print("Processing main image...")
-                with Image.open(image_path) as img:
-                    buffer = BytesIO()
-                    img.convert('RGB').save(buffer, format='JPEG')
-                    image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                messages_content.append({
-                    'type': 'image',
-                    'source': {
-                        'type': 'base64',
-                        'media_type': 'image/jpeg',
-                        'data': image_base64
-                    }
-                })
-            except Exception as e:
-                print(f"Error: Failed to process main image: {str(e)}")
-                return "Error generating caption", []
-
-            print("Sending request to Claude API...")
-            response = anthropic_client.messages.create(
-                model='claude-3-5-sonnet-latest',
-                max_tokens=1000,
-                messages=[{
-                    'role': 'user',
-                    'content': messages_content
-                }],
-                system=system_prompt,
-                response_model=PhotoAnalysis,
-                temperature=0
-            )
-
-            return response.caption, json.dumps([poi.model_dump() for poi in response.points_of_interest])
-            
-        except APIError as e:
-            if e.status_code == 429:  # Rate limit error
-                if attempt < max_retries - 1:
-                    delay = base_delay * (2 ** attempt)  # Exponential backoff
-                    print(f"Rate limited. Waiting {delay} seconds before retry {attempt + 1}/{max_retries}")
-                    time.sleep(delay)
-                    continue
-            print(f"API error after {attempt + 1} attempts: {str(e)}")
-            raise
-        except Exception as e:
-            print(f"Error generating caption and points of interest: {str(e)}")
-            return "Error generating caption", "[]"
-
 def get_location_name(lat, lon):
+    """'City, State' for the coordinates, or None if Nominatim has no place there.
+
+    Failures (network errors, HTTP errors) raise, so the geo cache keeps the
+    answer for places with no name but retries the lookups that failed.
+    """
     print(f"Getting location name for coordinates: {lat}, {lon}")
+    url = f'{NOMINATIM_URL}/reverse'
+    params = {
+        'lat': lat,
+        'lon': lon,
+        'format': 'jsonv2',
+        'accept-language': 'en'  # Request English names
+    }
     try:
-        url = 'https://nominatim.openstreetmap.org/reverse'
-        params = {
-            'lat': lat,
-            'lon': lon,
-            'format': 'jsonv2',
-            'accept-language': 'en'  # Request English names
-        }
-        headers = {
-            'Accept-Language': 'en'  # Additional header to ensure English response
-        }
-        response = requests.get(url, params=params, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            # Try to get the most relevant location name
-            address = data.get('address', {})
-            location = (
-                address.get('city') or 
-                address.get('town') or 
-                address.get('village') or 
-                address.get('suburb') or 
-                address.get('district')
-            )
-            # If we got a location, also get the state/prefecture for context
-            if location:
-                state = address.get('state') or address.get('province')
-                if state and state != location:
-                    location = f"{location}, {state}"
-                print(f"Location found: {location}")
-                return location
-            return None
-        else:
-            print(f"Error getting location name: HTTP {response.status_code}")
-            return None
-    except Exception as e:
-        print(f"Error getting location name: {str(e)}")
+        with metrics.timer('api_seconds', api='nominatim'):
+            response = nominatim_session.get(url, params=params, timeout=30)
+    except requests.RequestException:
+        metrics.count('api_calls_total', api='nominatim', status='error')
+        raise
+    metrics.count('api_calls_total', api='nominatim', status=response.status_code)
+    metrics.count('api_bytes_received_total', len(response.content), api='nominatim')
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}")
+    data = response.json()
+    # Try to get the most relevant location name
+    address = data.get('address', {})
+    location = (
+        address.get('city') or 
+        address.get('town') or 
+        address.get('village') or 
+        address.get('suburb') or 
+        address.get('district')
+    )
+    if not location:
+        print(f"No location name for coordinates: {lat}, {lon}")
         return None
+    # If we got a location, also get the state/prefecture for context
+    state = address.get('state') or address.get('province')
+    if state and state != location:
+        location = f"{location}, {state}"
+    print(f"Location found: {location}")
+    return location
 
 def generate_map_image(lat, lon, filename):
     if lat is None or lon is None:
@@ -303,7 +195,10 @@ def generate_map_image(lat, lon, filename):
 
         print("Querying Google Maps via SerpAPI...")
         search = GoogleSearch(params)
-        results = search.get_dict()
+        search.BACKEND = SERPAPI_URL
+        with metrics.timer('api_seconds', api='serpapi'):
+            results = search.get_dict()
+        metrics.count('api_calls_total', api='serpapi', status='error' if 'error' in results else 200)
 
         local_map = results.get("local_map")
         if not local_map or "image" not in local_map:
@@ -312,7 +207,10 @@ def generate_map_image(lat, lon, filename):
 
         image_url = local_map["image"]
         print("Downloading map image...")
-        response = requests.get(image_url)
+        with metrics.timer('api_seconds', api='map_image'):
+            response = requests.get(image_url)
+        metrics.count('api_calls_total', api='map_image', status=response.status_code)
+        metrics.count('api_bytes_received_total', len(response.content), api='map_image')
         if response.status_code == 200:
             map_filename = f'map_{filename}.jpg'
             map_filepath = os.path.join('maps', map_filename)
@@ -328,121 +226,376 @@ def generate_map_image(lat, lon, filename):
         print(f"Error generating map image: {str(e)}")
         return None
 
-def process_images():
+
+@dataclass
+class PipelineConfig:
+    """Concurrency and rate limits for each ingest stage (rates are calls/second)"""
+    local_workers: int = os.cpu_count() or 4
+    geocode_workers: int = 1
+    geocode_rate: float = 1.0  # Nominatim usage policy: at most 1 request/second
+    map_workers: int = 4
+    map_rate: float = 5.0
+    caption_workers: int = 4
+    caption_rate: float = 1.0
+    db_batch_size: int = 25
+    cache_path: str = 'geo_cache.db'
+    cache_ttl_days: float = 90
+    geocode_precision: int = 3  # ~100m, plenty for a "City, State" name
+    map_precision: int = 4  # ~10m, photos this close share a map screenshot
+    avif: bool = False
+    model_max_edge: int = 1568  # Claude downsizes anything larger anyway
+    batch: bool = False
+    batch_poll_interval: float = 60
+    report_path: str = 'reports/ingest-report.json'
+    prometheus_textfile: str = None
+    burst_dedupe: bool = True
+    burst_distance: int = BURST_DISTANCE  # differing dHash bits, out of 64
+    burst_seconds: float = BURST_SECONDS
+    gazetteer: str = None  # GeoNames cities file; names places offline instead of asking Nominatim
+    caption_prompt: str = CAPTION_PROMPT_PATH
+    deep_zoom: bool = True
+    mbtiles: str = None  # raster tile archive; draws maps locally instead of through SerpAPI
+    map_zoom: int = MAP_ZOOM
+
+def find_new_images(skip=()):
+    """Scan photos/ once; moved files are renamed in place, new and edited ones returned as records"""
+    conn = sqlite3.connect('photos.db')
+    try:
+        with metrics.timer('step_seconds', step='scan'):
+            result = manifest.scan(conn, 'photos', skip)
+        manifest.apply_moves(conn, result.moved)
+    finally:
+        conn.close()
+    print(f"Found {result.unchanged} unchanged, {len(result.moved)} moved and "
+          f"{len(result.new)} new or edited images")
+    if result.adopted:
+        print(f"Added {result.adopted} previously processed images to the file manifest")
+    return result.new
+
+def extract_local(record, limiter, formats=('webp',), model_max_edge=1568):
+    """Copy the image into static/photos, then decode it once for EXIF, derivatives and the model image"""
+    static_photos_path = os.path.join('static/photos', record['relative_path'])
+    os.makedirs(os.path.dirname(static_photos_path), exist_ok=True)
+    with metrics.timer('step_seconds', step='copy'):
+        shutil.copy2(record['absolute_path'], static_photos_path)
+    print(f"Copied image to {static_photos_path}")
+
+    with metrics.timer('step_seconds', step='decode'):
+        prepared = prepare_image(record['absolute_path'], model_max_edge, max(DERIVATIVE_SIZES.values()))
+    with metrics.timer('step_seconds', step='encode_derivatives'):
+        record['derivatives'] = generate_derivatives(prepared.image, record['relative_path'], formats=formats)
+    print(f"Generated {len(DERIVATIVE_SIZES)} derivative sizes for {record['relative_path']}")
+    with metrics.timer('step_seconds', step='dhash'):
+        record['dhash'] = dhash(prepared.image)
+    # The decoded pixels aren't needed downstream; don't hold them in the queues
+    prepared.image = None
+
+    exif_data = prepared.exif_data
+    gps_info = exif_data.get('GPSInfo')
+    latitude, longitude = get_lat_lon(gps_info) if gps_info else (None, None)
+    record.update(
+        prepared=prepared,
+        exif_data=exif_data,
+        date_taken=exif_data.get('DateTimeOriginal'),
+        latitude=latitude,
+        longitude=longitude,
+    )
+    return record
+
+def build_pyramid(record, limiter):
+    """Cut the full-resolution photo into Deep Zoom tiles for the full-screen viewer"""
+    record['deep_zoom'] = None
+    try:
+        with metrics.timer('step_seconds', step='deep_zoom'):
+            # The local stage decoded a reduced image; tiles need every pixel
+            with Image.open(os.path.join('static/photos', record['relative_path'])) as image:
+                record['deep_zoom'] = generate_pyramid(image, record['relative_path'])
+    except Exception as e:
+        print(f"Error building tiles for {record['relative_path']}: {str(e)}")
+    return record
+
+def geocode(record, limiter, cache, precision):
+    record['location_name'] = None
+    lat, lon = record['latitude'], record['longitude']
+    if lat and lon:
+        def fetch():
+            limiter.wait()
+            return get_location_name(lat, lon)
+        try:
+            record['location_name'] = cache.get_or_fetch(
+                'geocode', GeoCache.make_key(lat, lon, precision), fetch, cache_none=True
+            )
+        except Exception as e:
+            print(f"Error getting location name: {str(e)}")
+    return record
+
+def geocode_offline(record, limiter, geocoder):
+    lat, lon = record['latitude'], record['longitude']
+    record['location_name'] = geocoder.lookup(lat, lon) if lat and lon else None
+    return record
+
+def fetch_map(record, limiter, cache, precision):
+    record['map_image_path'] = None
+    lat, lon = record['latitude'], record['longitude']
+    if lat is not None and lon is not None:
+        key = GeoCache.make_key(lat, lon, precision)
+        def fetch():
+            limiter.wait()
+            # Name the map after the place, not the photo, so neighbours share it
+            return generate_map_image(lat, lon, key.replace(',', '_'))
+        record['map_image_path'] = cache.get_or_fetch('map', key, fetch, is_valid=os.path.exists)
+    return record
+
+def caption(record, limiter, prompt=None):
+    limiter.wait()
+    caption_text, points_of_interest_json = generate_caption(
+        record.pop('prepared'),
+        record['photographer'],
+        record['map_image_path'],
+        record['location_name'],
+        prompt
+    )
+    record.update(caption=caption_text, points_of_interest=points_of_interest_json)
+    return record
+
+def render_map(record, limiter, renderer, precision):
+    record['map_image_path'] = None
+    lat, lon = record['latitude'], record['longitude']
+    if lat is not None and lon is not None:
+        # Same file name as a SerpAPI map of the spot, so neighbours share it. Centre
+        # it on the rounded spot too, so every neighbour writes the same image.
+        key = GeoCache.make_key(lat, lon, precision)
+        rounded_lat, rounded_lon = (float(value) for value in key.split(','))
+        record['map_image_path'] = renderer.save(rounded_lat, rounded_lon, key.replace(',', '_'))
+    return record
+
+def derivative_formats(config):
+    if config.avif and not avif_available():
+        print("Warning: AVIF requested but this Pillow build can't encode it; writing WebP only")
+        return ('webp',)
+    return ('webp', 'avif') if config.avif else ('webp',)
+
+def rebuild_derivatives(config=None):
+    """Regenerate derivatives, tile pyramids and perceptual hashes for photos already in the database"""
+    config = config or PipelineConfig()
+    setup_database.setup_database()
+    formats = derivative_formats(config)
+    conn = sqlite3.connect('photos.db')
+    rows = conn.execute('SELECT id, file_path FROM photo').fetchall()
+    print(f"Rebuilding derivatives for {len(rows)} photos...")
+
+    def build(row):
+        photo_id, relative_path = row
+        try:
+            with Image.open(os.path.join('static/photos', relative_path)) as image:
+                image = ImageOps.exif_transpose(image)
+                deep_zoom = generate_pyramid(image, relative_path) if config.deep_zoom else None
+                return (photo_id, generate_derivatives(image, relative_path, formats=formats),
+                        deep_zoom, dhash(image))
+        except Exception as e:
+            print(f"Error building derivatives for {relative_path}: {str(e)}")
+            return photo_id, None, None, None
+
+    with ThreadPoolExecutor(max_workers=config.local_workers) as executor:
+        for photo_id, derivatives, deep_zoom, hash_value in executor.map(build, rows):
+            if derivatives:
+                conn.execute('UPDATE photo SET derivatives = ?, dhash = ? WHERE id = ?',
+                             (json.dumps(derivatives), hash_value, photo_id))
+            if deep_zoom:
+                # A --no-deep-zoom run keeps the pyramids already built
+                conn.execute('UPDATE photo SET deep_zoom = ? WHERE id = ?', (deep_zoom, photo_id))
+    conn.commit()
+    conn.close()
+    print("Derivatives rebuilt!")
+
+def process_images(config=None):
+    config = config or PipelineConfig()
+    metrics.reset()
+    try:
+        run_pipeline(config)
+    finally:
+        write_run_report(config)
+
+def write_run_report(config):
+    """Print where the time went and save the run's metrics for later comparison"""
+    metrics.print_summary()
+    if config.report_path:
+        metrics.write_report(config.report_path)
+    if config.prometheus_textfile:
+        metrics.write_prometheus(config.prometheus_textfile)
+
+def run_pipeline(config):
     print("Starting image processing...")
-    check_required_env_vars()
+    check_required_env_vars(need_serpapi=not config.mbtiles)
     ensure_directories()
     
     print("Setting up database...")
     setup_database.setup_database()
     
-    # Get already processed files
-    processed_files = get_processed_files()
-    print(f"Found {len(processed_files)} already processed files")
-
-    conn = sqlite3.connect('photos.db')
-    cursor = conn.cursor()
-
-    total_images = 0
-    processed_images = 0
-
-    # Count only unprocessed images
-    for root, dirs, files in os.walk('photos'):
-        for filename in files:
-            if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-                relative_path = os.path.relpath(os.path.join(root, filename), 'photos')
-                if relative_path not in processed_files:
-                    total_images += 1
-
-    print(f"Found {total_images} new images to process")
+    # Photos waiting on an earlier batch are collected below, not resubmitted
+    new_images = find_new_images(pending_batch_paths() if config.batch else ())
+    total_images = len(new_images)
+    if not new_images:
+        if config.batch:
+            collect_batches(poll_interval=config.batch_poll_interval, db_batch_size=config.db_batch_size)
+            rebuild_clusters()
+            rebuild_facets()
+        print("\nImage processing completed!")
+        return
+
+    # Read the prompt before any work starts, so a broken template fails the run right away
+    prompt = load_prompt(config.caption_prompt)
+    check_prompt_caching(prompt)
+
+    # Each stage is its own bounded pool, so a slow external service only
+    # limits its own stage and the others keep working on later photos.
+    cache = GeoCache(config.cache_path, config.cache_ttl_days)
+    first = Stage('local', partial(extract_local, formats=derivative_formats(config),
+                                   model_max_edge=config.model_max_edge), config.local_workers)
+    last = first
+    if config.deep_zoom:
+        last = last.then(Stage('deep_zoom', build_pyramid, config.local_workers))
+    bursts = None
+    if config.burst_dedupe:
+        # One worker, so every photo is grouped against all earlier ones
+        bursts = BurstGroups(max_distance=config.burst_distance, window=config.burst_seconds)
+        last = last.then(Stage('bursts', bursts.assign, 1))
+    if config.gazetteer:
+        # Microseconds per lookup: no cache, no rate limit and one worker is plenty
+        geocoder = OfflineGeocoder.load(config.gazetteer)
+        last = last.then(Stage('geocode', partial(geocode_offline, geocoder=geocoder), 1))
+    else:
+        last = last.then(Stage('geocode', partial(geocode, cache=cache, precision=config.geocode_precision),
+                               config.geocode_workers, config.geocode_rate))
+    renderer = None
+    if config.mbtiles:
+        # Milliseconds per map from tiles on disk: no cache and no rate limit
+        renderer = MBTilesRenderer(config.mbtiles, config.map_zoom)
+        last = last.then(Stage('map', partial(render_map, renderer=renderer, precision=config.map_precision),
+                               config.map_workers))
+    else:
+        last = last.then(Stage('map', partial(fetch_map, cache=cache, precision=config.map_precision),
+                               config.map_workers, config.map_rate))
+    writer = submitter = None
+    if config.batch:
+        submitter = BatchSubmitter(prompt=prompt)
+        last.then(Stage('batch', submitter.add, 1, config.caption_rate))
+    else:
+        writer = DatabaseWriter(batch_size=config.db_batch_size)
+        last = last.then(Stage('caption', partial(caption, prompt=prompt),
+                               config.caption_workers, config.caption_rate))
+        if bursts is not None:
+            # Captioned photos release their waiting burst shots on the way to the writer
+            last = last.then(bursts)
+        last.then(writer)
+
+    stage = first
+    while isinstance(stage, Stage):
+        stage.start()
+        stage = stage.next_stage
+    if writer is not None:
+        writer.start()
 
     try:
-        for root, dirs, files in os.walk('photos'):
-            for filename in files:
-                if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    file_path = os.path.join(root, filename)
-                    relative_path = os.path.relpath(file_path, 'photos')
-                    
-                    # Skip if already processed
-                    if relative_path in processed_files:
-                        print(f"Skipping already processed image: {filename}")
-                        continue
-                        
-                    processed_images += 1
-                    print(f"\nProcessing image {processed_images}/{total_images}: {filename}")
-                    
-                    photographer = os.path.basename(root)
-                    absolute_path = file_path
-
-                    # Copy the image to static/photos directory
-                    static_photos_path = os.path.join('static/photos', relative_path)
-                    os.makedirs(os.path.dirname(static_photos_path), exist_ok=True)
-                    shutil.copy2(absolute_path, static_photos_path)
-                    print(f"Copied image to {static_photos_path}")
-
-                    print("Extracting image metadata...")
-                    exif_data = get_exif_data(absolute_path)
-                    date_taken = exif_data.get('DateTimeOriginal')
-                    if date_taken:
-                        print(f"Photo taken on: {date_taken}")
-
-                    gps_info = exif_data.get('GPSInfo')
-                    latitude, longitude = get_lat_lon(gps_info) if gps_info else (None, None)
-                    if latitude and longitude:
-                        print(f"GPS coordinates: {latitude}, {longitude}")
-
-                    location_name = get_location_name(latitude, longitude) if latitude and longitude else None
-                    map_image_path = generate_map_image(latitude, longitude, filename)
-
-                    try:
-                        caption, points_of_interest_json = generate_caption(
-                            absolute_path, 
-                            photographer, 
-                            map_image_path,
-                            location_name
-                        )
-                        location_name = get_location_name(latitude, longitude) if latitude and longitude else None
-                        
-                        # First insert the photo
-                        cursor.execute('''
-                            INSERT INTO photo (
-                                file_path, caption, date_taken, 
-                                latitude, longitude, location_name, exif_data, photographer
-                            )
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (
-                            relative_path, caption, date_taken, 
-                            latitude, longitude, location_name, str(exif_data), photographer
-                        ))
-                        
-                        # Get the photo_id of the just-inserted photo
-                        photo_id = cursor.lastrowid
-                        
-                        # Parse the points of interest JSON and insert each point
-                        points_of_interest = json.loads(points_of_interest_json)
-                        for poi in points_of_interest:
-                            cursor.execute('''
-                                INSERT INTO point_of_interest (
-                                    photo_id, name, description
-                                )
-                                VALUES (?, ?, ?)
-                            ''', (
-                                photo_id, poi['name'], poi['description']
-                            ))
-                        
-                        print("Database entries created successfully")
-                    except sqlite3.Error as e:
-                        print(f"Error inserting into database: {str(e)}")
-
-                    conn.commit()  # Commit after each successful image
-                    
-    except Exception as e:
-        print(f"Error during processing: {str(e)}")
-        conn.commit()  # Ensure we save progress even on error
-        raise
+        for index, record in enumerate(new_images, 1):
+            print(f"\nQueueing image {index}/{total_images}: {record['relative_path']}")
+            first.put(record)
     finally:
-        conn.close()
+        # Closing the first stage drains every stage in order, then the writer
+        first.close()
+        cache.report()
+        cache.close()
+        if renderer is not None:
+            renderer.close()
+
+    if submitter is not None:
+        submitter.flush()
+        print(f"\nSubmitted {submitter.submitted}/{total_images} new images for batch captioning")
+        collect_batches(poll_interval=config.batch_poll_interval, db_batch_size=config.db_batch_size)
+        if bursts is not None:
+            bursts.release_written(config.db_batch_size)
+        rebuild_clusters()
+        rebuild_facets()
         print("\nImage processing completed!")
+    else:
+        written = writer.written
+        if bursts is not None:
+            written += bursts.release_written(config.db_batch_size)
+        if written:
+            rebuild_clusters()
+            rebuild_facets()
+        print(f"\nImage processing completed! Saved {written}/{total_images} new images")
+    if bursts is not None and bursts.siblings:
+        print(f"{bursts.siblings} burst shots reused the caption of a near-identical photo")
+
+def parse_args(argv=None):
+    """Parse command line options; pipeline settings become a PipelineConfig on args.config"""
+    defaults = PipelineConfig()
+    parser = argparse.ArgumentParser(description="Caption and catalog new photos in photos/")
+    parser.add_argument('--local-workers', type=int, default=defaults.local_workers,
+                        help="Threads for copying files and reading EXIF")
+    parser.add_argument('--geocode-workers', type=int, default=defaults.geocode_workers)
+    parser.add_argument('--geocode-rate', type=float, default=defaults.geocode_rate,
+                        help="Max Nominatim requests per second")
+    parser.add_argument('--map-workers', type=int, default=defaults.map_workers)
+    parser.add_argument('--map-rate', type=float, default=defaults.map_rate,
+                        help="Max SerpAPI map lookups per second")
+    parser.add_argument('--caption-workers', type=int, default=defaults.caption_workers)
+    parser.add_argument('--caption-rate', type=float, default=defaults.caption_rate,
+                        help="Max Claude requests per second")
+    parser.add_argument('--db-batch-size', type=int, default=defaults.db_batch_size,
+                        help="Photos per SQLite transaction")
+    parser.add_argument('--cache-path', default=defaults.cache_path,
+                        help="SQLite file caching geocode results and map images")
+    parser.add_argument('--cache-ttl-days', type=float, default=defaults.cache_ttl_days,
+                        help="Expire cached places after this many days (0 keeps them forever)")
+    parser.add_argument('--geocode-precision', type=int, default=defaults.geocode_precision,
+                        help="Decimal places of lat/lon that share a geocode result")
+    parser.add_argument('--map-precision', type=int, default=defaults.map_precision,
+                        help="Decimal places of lat/lon that share a map image")
+    parser.add_argument('--gazetteer',
+                        help="GeoNames cities file (e.g. cities15000.zip, with admin1CodesASCII.txt next to it) "
+                             "to name places offline instead of with Nominatim")
+    parser.add_argument('--mbtiles',
+                        help="MBTiles archive of raster map tiles to draw the map given to Claude from, "
+                             "instead of looking one up through SerpAPI")
+    parser.add_argument('--map-zoom', type=int, default=defaults.map_zoom,
+                        help="Zoom level of maps drawn from --mbtiles")
+    parser.add_argument('--avif', action='store_true',
+                        help="Also write AVIF derivatives (needs a Pillow build with AVIF support)")
+    parser.add_argument('--model-max-edge', type=int, default=defaults.model_max_edge,
+                        help="Longest edge in pixels of the photo sent to Claude")
+    parser.add_argument('--batch', action='store_true',
+                        help="Caption through the Message Batches API instead of one request per photo; "
+                             "rerun to resume an interrupted batch")
+    parser.add_argument('--batch-poll-interval', type=float, default=defaults.batch_poll_interval,
+                        help="Seconds between batch status checks")
+    parser.add_argument('--report-path', default=defaults.report_path,
+                        help="Write per-stage timings, API call counts and token usage of the run as JSON here")
+    parser.add_argument('--prometheus-textfile',
+                        help="Also write the run's metrics in Prometheus text format, e.g. for "
+                             "node_exporter's textfile collector")
+    parser.add_argument('--no-burst-dedupe', dest='burst_dedupe', action='store_false',
+                        help="Caption every photo, even near-identical burst shots")
+    parser.add_argument('--burst-distance', type=int, default=defaults.burst_distance,
+                        help="Max differing bits of the 64-bit perceptual hash for two shots to be a burst")
+    parser.add_argument('--burst-seconds', type=float, default=defaults.burst_seconds,
+                        help="Max seconds between two shots of a burst")
+    parser.add_argument('--caption-prompt', default=defaults.caption_prompt,
+                        help="Prompt file: instructions for every photo, a '=== per photo ===' line, "
+                             "then the per-photo template")
+    parser.add_argument('--no-deep-zoom', dest='deep_zoom', action='store_false',
+                        help="Don't cut photos into Deep Zoom tiles for zooming in the full-screen viewer")
+    parser.add_argument('--rebuild-derivatives', action='store_true',
+                        help="Regenerate derivatives, tile pyramids and perceptual hashes for already "
+                             "processed photos and exit")
+    args = parser.parse_args(argv)
+    args.config = PipelineConfig(**{f.name: getattr(args, f.name) for f in fields(PipelineConfig)})
+    return args
 
 if __name__ == '__main__':
-    process_images() 
\ No newline at end of file
+    args = parse_args()
+    if args.rebuild_derivatives:
+        rebuild_derivatives(args.config)
+    else:
+        process_images(args.config)
@@ -0,0 +1,125 @@
+"""Full-text search over captions, locations, photographers and points of interest.
+
+photo_search is an FTS5 table with one row per photo (rowid = photo.id). The
+triggers created here keep it in step with photo and point_of_interest, so
+ingest, moves and edits need no extra code.
+"""
+import html
+import re
+
+# bm25 weights, in column order: a hit in the location or a point of interest
+# says more about the photo than the same word somewhere in the caption
+COLUMN_WEIGHTS = (2.0, 5.0, 4.0, 1.0)
+
+# Queries matching more photos than this are ordered by recency, not bm25
+MAX_RANKED_MATCHES = 2000
+
+# snippet() markers that can't occur in captions; swapped for <mark> after escaping
+_MARK_START, _MARK_END = '\x02', '\x03'
+
+_POINTS_OF_INTEREST = '''
+    (SELECT group_concat(name || ' ' || coalesce(description, ''), ' ')
+     FROM point_of_interest WHERE photo_id = {photo_id})
+'''
+
+def create_index(cursor):
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS photo_search USING fts5(
+            caption, location_name, points_of_interest, photographer,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    ''')
+    # Makes ORDER BY rank use the weighted bm25, computed inside FTS5
+    weights = ', '.join(str(weight) for weight in COLUMN_WEIGHTS)
+    cursor.execute(f"INSERT INTO photo_search (photo_search, rank) VALUES ('rank', 'bm25({weights})')")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS photo_search_insert AFTER INSERT ON photo BEGIN
+            INSERT INTO photo_search (rowid, caption, location_name, points_of_interest, photographer)
+            VALUES (new.id, new.caption, new.location_name, '', new.photographer);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS photo_search_update
+        AFTER UPDATE OF caption, location_name, photographer ON photo BEGIN
+            UPDATE photo_search
+            SET caption = new.caption, location_name = new.location_name, photographer = new.photographer
+            WHERE rowid = new.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS photo_search_delete AFTER DELETE ON photo BEGIN
+            DELETE FROM photo_search WHERE rowid = old.id;
+        END
+    ''')
+    for event, row in (('INSERT', 'new'), ('UPDATE', 'new'), ('DELETE', 'old')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS photo_search_poi_{event.lower()}
+            AFTER {event} ON point_of_interest BEGIN
+                UPDATE photo_search
+                SET points_of_interest = coalesce({_POINTS_OF_INTEREST.format(photo_id=f'{row}.photo_id')}, '')
+                WHERE rowid = {row}.photo_id;
+            END
+        ''')
+
+def rebuild_index(cursor):
+    """Refill photo_search from scratch, e.g. for a database that predates it"""
+    cursor.execute('DELETE FROM photo_search')
+    cursor.execute(f'''
+        INSERT INTO photo_search (rowid, caption, location_name, points_of_interest, photographer)
+        SELECT id, caption, location_name, coalesce({_POINTS_OF_INTEREST.format(photo_id='photo.id')}, ''), photographer
+        FROM photo
+    ''')
+
+def match_expression(text, prefix=False):
+    """FTS5 query matching every word of `text`, with the last one as a prefix for typeahead.
+
+    Words are quoted, so FTS5 operators and punctuation typed by users are
+    searched for literally rather than parsed.
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    # A one-letter prefix would expand to a large share of the vocabulary
+    if prefix and len(words[-1]) > 1:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def highlight(snippet):
+    """HTML-escape a snippet and turn the match markers into <mark> tags"""
+    return html.escape(snippet).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+def search_photos(conn, text, limit=20, offset=0, prefix=False):
+    """Best matches first; returns (rows, has_more).
+
+    Ranking and snippets are separate queries: snippet() is costly, and in a
+    single query it would run for every match before ORDER BY ... LIMIT.
+    """
+    expression = match_expression(text, prefix)
+    if expression is None:
+        return [], False
+    # bm25 has to score every match, so ranking a word found in most photos (a
+    # city, a short prefix) would take tens of ms; broad queries like that say
+    # little about relevance and list the newest photos instead
+    matches = conn.execute('SELECT rowid FROM photo_search WHERE photo_search MATCH ? LIMIT ?',
+                           (expression, MAX_RANKED_MATCHES + 1)).fetchall()
+    order = 'rank' if len(matches) <= MAX_RANKED_MATCHES else 'rowid DESC'
+    ids = [row['rowid'] for row in conn.execute(
+        f'SELECT rowid FROM photo_search WHERE photo_search MATCH ? ORDER BY {order} LIMIT ? OFFSET ?',
+        (expression, limit + 1, offset)
+    )]
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    if not ids:
+        return [], False
+    placeholders = ', '.join('?' * len(ids))
+    rows = conn.execute(f'''
+        SELECT p.id, p.file_path, p.caption, p.location_name, p.taken_at, p.derivatives,
+               snippet(photo_search, -1, ?, ?, '…', 12) AS snippet
+        FROM photo_search
+        JOIN photo p ON p.id = photo_search.rowid
+        WHERE photo_search MATCH ? AND photo_search.rowid IN ({placeholders})
+    ''', (_MARK_START, _MARK_END, expression, *ids)).fetchall()
+    position = {photo_id: index for index, photo_id in enumerate(ids)}
+    return sorted(rows, key=lambda row: position[row['id']]), has_more
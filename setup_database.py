@@ -1,7 +1,178 @@
+import ast
+import json
 import sqlite3
+from pipeline import exif_datetime_to_iso, exif_json
+import facets
+import map_clusters
+import search
+from exif_reader import compact_exif
+from map_clusters import photo_quadkey
+
+def ensure_column(cursor, table, column, definition):
+    """Add a column to an existing table if an older database is missing it"""
+    columns = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def _literal_exif(text):
+    """Parse exif_data written as str(dict) by older versions (repr of NaN is a bare `nan`)"""
+    tree = ast.parse(text, mode='eval')
+    for node in ast.walk(tree):
+        for field, child in ast.iter_fields(node):
+            if isinstance(child, list):
+                child[:] = [ast.Constant(None) if isinstance(c, ast.Name) and c.id in ('nan', 'inf') else c
+                            for c in child]
+            elif isinstance(child, ast.Name) and child.id in ('nan', 'inf'):
+                setattr(node, field, ast.Constant(None))
+    return ast.literal_eval(tree)
+
+def _compact_exif_json(text):
+    try:
+        exif_data = json.loads(text)
+    except (TypeError, ValueError):
+        return text
+    return json.dumps(compact_exif(exif_data)) if isinstance(exif_data, dict) else text
+
+def _exif_text_to_json(text):
+    if not text:
+        return exif_json({})
+    try:
+        json.loads(text)
+        return text
+    except ValueError:
+        pass
+    try:
+        return exif_json(_literal_exif(text))
+    except (ValueError, SyntaxError):
+        # Reprs that can't be read back; keep the text rather than lose it
+        return json.dumps({'unparsed': text})
+
+def migrate_photo_indexes(cursor):
+    """Index the sort columns and point_of_interest.photo_id"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_photo_location_name ON photo (location_name, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_point_of_interest_photo_id ON point_of_interest (photo_id)')
+
+def migrate_unique_file_path(cursor):
+    """Make photo.file_path unique, keeping the first copy of any duplicates"""
+    duplicates = 'SELECT id FROM photo WHERE id NOT IN (SELECT MIN(id) FROM photo GROUP BY file_path)'
+    cursor.execute(f'DELETE FROM point_of_interest WHERE photo_id IN ({duplicates})')
+    cursor.execute(f'DELETE FROM photo WHERE id IN ({duplicates})')
+    if cursor.rowcount:
+        print(f"Removed {cursor.rowcount} duplicate photo rows")
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_photo_file_path ON photo (file_path)')
+
+def migrate_taken_at(cursor):
+    """Add photo.taken_at, the capture time as sortable ISO 8601"""
+    ensure_column(cursor, 'photo', 'taken_at', 'TEXT')
+    rows = cursor.execute('SELECT id, date_taken FROM photo WHERE date_taken IS NOT NULL').fetchall()
+    cursor.executemany('UPDATE photo SET taken_at = ? WHERE id = ?',
+                       [(exif_datetime_to_iso(date_taken), photo_id) for photo_id, date_taken in rows])
+    cursor.execute('DROP INDEX IF EXISTS idx_photo_date_taken')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_photo_taken_at ON photo (taken_at, id)')
+
+def migrate_exif_json(cursor):
+    """Convert photo.exif_data from str(dict) to JSON"""
+    rows = cursor.execute('SELECT id, exif_data FROM photo').fetchall()
+    cursor.executemany('UPDATE photo SET exif_data = ? WHERE id = ?',
+                       [(_exif_text_to_json(exif_data), photo_id) for photo_id, exif_data in rows])
+    # Photos still waiting on a caption batch carry their EXIF in the stored record
+    items = cursor.execute("SELECT custom_id, record FROM caption_batch_item WHERE status = 'pending'").fetchall()
+    updates = []
+    for custom_id, record in items:
+        record = json.loads(record)
+        record['exif_data'] = _exif_text_to_json(record.get('exif_data'))
+        updates.append((json.dumps(record), custom_id))
+    cursor.executemany('UPDATE caption_batch_item SET record = ? WHERE custom_id = ?', updates)
+
+def migrate_file_manifest(cursor):
+    """Add file_manifest, the content hash, size and mtime of every ingested file"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_manifest (
+            relative_path TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_manifest_content_hash ON file_manifest (content_hash)')
+
+def migrate_map_clusters(cursor):
+    """Add photo.quadkey and the precomputed map_cluster tables"""
+    ensure_column(cursor, 'photo', 'quadkey', 'TEXT')
+    rows = cursor.execute('SELECT id, latitude, longitude FROM photo WHERE latitude IS NOT NULL').fetchall()
+    cursor.executemany('UPDATE photo SET quadkey = ? WHERE id = ?',
+                       [(photo_quadkey(lat, lon), photo_id) for photo_id, lat, lon in rows])
+    map_clusters.create_tables(cursor)
+    map_clusters.build_clusters(cursor)
+
+def migrate_search_index(cursor):
+    """Add the photo_search full-text index and the triggers that maintain it"""
+    search.create_index(cursor)
+    search.rebuild_index(cursor)
+
+def migrate_bursts(cursor):
+    """Add photo.dhash and photo.burst_of, linking burst shots to the photo captioned for them"""
+    ensure_column(cursor, 'photo', 'dhash', 'TEXT')
+    ensure_column(cursor, 'photo', 'burst_of', 'INTEGER REFERENCES photo (id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_photo_burst_of ON photo (burst_of)')
+
+def migrate_compact_exif(cursor):
+    """Keep only the EXIF tags ingest reads in photo.exif_data, dropping MakerNote and other blobs"""
+    rows = cursor.execute('SELECT id, exif_data FROM photo').fetchall()
+    cursor.executemany('UPDATE photo SET exif_data = ? WHERE id = ?',
+                       [(_compact_exif_json(exif_data), photo_id) for photo_id, exif_data in rows])
+    items = cursor.execute("SELECT custom_id, record FROM caption_batch_item WHERE status = 'pending'").fetchall()
+    updates = []
+    for custom_id, record in items:
+        record = json.loads(record)
+        record['exif_data'] = _compact_exif_json(record.get('exif_data'))
+        updates.append((json.dumps(record), custom_id))
+    cursor.executemany('UPDATE caption_batch_item SET record = ? WHERE custom_id = ?', updates)
+
+def migrate_facets(cursor):
+    """Add the photo_facet counts behind /api/facets"""
+    facets.create_tables(cursor)
+    facets.build_facets(cursor)
+
+def migrate_deep_zoom(cursor):
+    """Add photo.deep_zoom, the .dzi of the photo's tile pyramid for the full-screen viewer"""
+    ensure_column(cursor, 'photo', 'deep_zoom', 'TEXT')
+
+# Applied in order; PRAGMA user_version records how many have run.
+# Only ever append to this list.
+MIGRATIONS = [
+    migrate_photo_indexes,
+    migrate_unique_file_path,
+    migrate_taken_at,
+    migrate_exif_json,
+    migrate_file_manifest,
+    migrate_map_clusters,
+    migrate_search_index,
+    migrate_bursts,
+    migrate_compact_exif,
+    migrate_facets,
+    migrate_deep_zoom,
+]
+
+def migrate(conn):
+    """Bring an existing database up to date, one transaction per migration"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"Applying migration {number}: {migration.__doc__}")
+        conn.execute('BEGIN')
+        try:
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
 def setup_database():
     conn = sqlite3.connect('photos.db')
+    # WAL lets the web app keep reading while ingest writes; the setting is
+    # stored in the database file, so every later connection gets it
+    conn.execute('PRAGMA journal_mode = WAL')
     cursor = conn.cursor()
     
     # Create photo table
@@ -15,9 +186,13 @@ def setup_database():
             longitude REAL,
             location_name TEXT,
             exif_data TEXT,
-            photographer TEXT
+            photographer TEXT,
+            derivatives TEXT
         )
     ''')
+
+    # JSON map of derivative size -> {width, height, webp, avif} paths
+    ensure_column(cursor, 'photo', 'derivatives', 'TEXT')
     
     # Create point_of_interest table
     cursor.execute('''
@@ -30,7 +205,32 @@ def setup_database():
         )
     ''')
     
+    # Message batches submitted by `process_images.py --batch`, kept so an
+    # interrupted run can resume polling and write the results later
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS caption_batch (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id TEXT NOT NULL UNIQUE,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            ended_at TEXT
+        )
+    ''')
+
+    # One row per photo in a batch; `record` is the JSON photo row awaiting its caption
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS caption_batch_item (
+            custom_id TEXT PRIMARY KEY,
+            batch_id TEXT NOT NULL,
+            relative_path TEXT NOT NULL,
+            record TEXT NOT NULL,
+            status TEXT NOT NULL,
+            FOREIGN KEY (batch_id) REFERENCES caption_batch (batch_id)
+        )
+    ''')
+    
     conn.commit()
+    migrate(conn)
     conn.close()
 
 if __name__ == '__main__':
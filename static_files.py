@@ -0,0 +1,255 @@
+"""Static files and response compression tuned for a photo site.
+
+- CachedStaticFiles serves /static with strong content-hash ETags, Range
+  support and `Cache-Control: immutable` whenever the URL carries the file's
+  content hash, either in the name (photo derivatives) or as `?v=` (asset_url).
+  Deep Zoom pyramids are immutable too: the .dzi and the tile directory are
+  named after the hash of all the tiles and never rewritten (deep_zoom.py).
+  Precompressed `.br`/`.gz` siblings are sent when the client accepts them.
+- CompressedBody compresses a generated body (the page shell, the catalog)
+  once, instead of on every request.
+- CompressionMiddleware compresses the remaining dynamic text responses and
+  leaves images and anything already encoded alone.
+
+Run `python static_files.py` after changing files in static/ to write the
+`.gz`/`.br` siblings. Brotli needs the optional `brotli` package; without it
+only gzip is used.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from functools import lru_cache
+from urllib.parse import parse_qs
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles, NotModifiedResponse
+from instrumentation import phase
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Length of the content-hash prefix used in URLs and file names
+HASH_LENGTH = 12
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+# Types worth compressing; images, video and archives are compressed already
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml', 'application/xml')
+PRECOMPRESS_EXTENSIONS = ('.html', '.css', '.js', '.json', '.svg', '.txt', '.xml')
+MINIMUM_SIZE = 1000
+
+# Preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz')) if brotli else (('gzip', '.gz'),)
+
+_HASHED_NAME = re.compile(r'\.([0-9a-f]{%d})\.[A-Za-z0-9]+$' % HASH_LENGTH)
+# <stem>.<hash>.dzi and <stem>.<hash>_files/<level>/<column>_<row>.jpg, hashed by their tiles
+_DEEP_ZOOM = re.compile(r'\.[0-9a-f]{%d}(\.dzi|_files/\d+/\d+_\d+\.[A-Za-z0-9]+)$' % HASH_LENGTH)
+
+mimetypes.add_type('application/xml', '.dzi')
+
+def is_compressible(content_type):
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+def compress(body, encoding, best=True):
+    """Compress `body`; best=False trades some size for speed on per-request work"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if best else 5)
+    return gzip.compress(body, compresslevel=9 if best else 6, mtime=0)
+
+def accepted_encodings(headers):
+    """Encodings the client accepts, from its Accept-Encoding header"""
+    accepted = set()
+    for part in headers.get('accept-encoding', '').split(','):
+        name, _, params = part.strip().partition(';')
+        if name and params.replace(' ', '') not in ('q=0', 'q=0.0'):
+            accepted.add(name.lower())
+    return accepted
+
+def etag_matches(headers, etag):
+    """True if If-None-Match names `etag` or one of its encoded variants"""
+    bare = etag.strip('"')
+    for candidate in headers.get('if-none-match', '').split(','):
+        candidate = candidate.strip().removeprefix('W/').strip('"')
+        if candidate == '*' or candidate == bare or candidate.rsplit('-', 1)[0] == bare:
+            return True
+    return False
+
+def file_hash(path):
+    """sha256 of a file's content, cached until its size or mtime changes"""
+    stat = os.stat(path)
+    return _file_info(path, stat.st_size, stat.st_mtime_ns)[0]
+
+@lru_cache(maxsize=65536)
+def _file_info(path, size, mtime_ns):
+    with open(path, 'rb') as f:
+        digest = hashlib.file_digest(f, 'sha256').hexdigest()
+    variants = {}
+    for encoding, extension in ENCODINGS:
+        try:
+            variant_stat = os.stat(path + extension)
+        except FileNotFoundError:
+            continue
+        # Older than the original means it was compressed from a previous version
+        if variant_stat.st_mtime_ns >= mtime_ns:
+            variants[encoding] = (path + extension, variant_stat)
+    return digest, variants
+
+class CachedStaticFiles(StaticFiles):
+    def lookup_path(self, path):
+        # Runs in a worker thread, so hash (first time only) here rather than on the event loop
+        full_path, stat_result = super().lookup_path(path)
+        if stat_result is not None and not os.path.isdir(full_path):
+            _file_info(full_path, stat_result.st_size, stat_result.st_mtime_ns)
+        return full_path, stat_result
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        digest, variants = _file_info(str(full_path), stat_result.st_size, stat_result.st_mtime_ns)
+
+        # Immutable only if the URL names this exact content
+        match = _HASHED_NAME.search(os.path.basename(full_path))
+        version = parse_qs(scope.get('query_string', b'').decode()).get('v', [''])[0]
+        pinned = (match and digest.startswith(match.group(1))) or (
+            len(version) >= 8 and digest.startswith(version)) or bool(
+            _DEEP_ZOOM.search(str(full_path).replace(os.sep, '/')))
+
+        media_type = mimetypes.guess_type(str(full_path))[0] or 'application/octet-stream'
+        headers = {
+            'etag': f'"{digest[:32]}"',
+            'cache-control': IMMUTABLE if pinned else REVALIDATE,
+        }
+        path = full_path
+        accepted = accepted_encodings(request_headers)
+        for encoding, _ in ENCODINGS:
+            if encoding in variants and encoding in accepted:
+                path, stat_result = variants[encoding]
+                headers['etag'] = f'"{digest[:32]}-{encoding}"'
+                headers['content-encoding'] = encoding
+                break
+        if variants:
+            headers['vary'] = 'Accept-Encoding'
+
+        # FileResponse answers Range and If-Range requests itself
+        response = FileResponse(path, status_code=status_code, stat_result=stat_result,
+                                media_type=media_type, headers=headers)
+        if etag_matches(request_headers, headers['etag']):
+            return NotModifiedResponse(response.headers)
+        return response
+
+def asset_url(path):
+    """URL of a file in static/ pinned to its content, so it can be cached forever"""
+    return f"/static/{path}?v={file_hash(os.path.join('static', path))[:HASH_LENGTH]}"
+
+class CompressedBody:
+    """A generated response body, compressed once in every encoding we can send"""
+    def __init__(self, body, media_type, etag=None, best=True):
+        self.media_type = media_type
+        self.etag = etag or '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.variants = {'identity': body}
+        if len(body) >= MINIMUM_SIZE:
+            with phase('compress'):
+                for encoding, _ in ENCODINGS:
+                    self.variants[encoding] = compress(body, encoding, best)
+
+    def response(self, request, cache_control=REVALIDATE):
+        accepted = accepted_encodings(request.headers)
+        encoding = next((name for name, _ in ENCODINGS if name in accepted and name in self.variants), 'identity')
+        headers = {
+            'ETag': self.etag if encoding == 'identity' else f'{self.etag[:-1]}-{encoding}"',
+            'Cache-Control': cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+        if etag_matches(request.headers, self.etag):
+            return Response(status_code=304, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(content=self.variants[encoding], media_type=self.media_type, headers=headers)
+
+class CompressionMiddleware:
+    """Compress dynamic text responses; pass through images, ranges and pre-encoded bodies untouched.
+
+    Unlike GZipMiddleware this never spends CPU on JPEG/WebP/AVIF bytes and
+    doesn't recompress bodies that CachedStaticFiles or CompressedBody
+    already sent encoded. Compressible bodies are buffered, which is fine for
+    the API's JSON pages.
+    """
+    def __init__(self, app, minimum_size=MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        accepted = accepted_encodings(request_headers)
+        encoding = next((name for name, _ in ENCODINGS if name in accepted), None)
+        # Byte ranges are of the identity body, so a ranged request must get it as is
+        if encoding is None or 'range' in request_headers:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        chunks = []
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, passthrough
+            if message['type'] == 'http.response.start':
+                headers = Headers(raw=message['headers'])
+                if ('content-encoding' in headers or message['status'] == 206 or 'content-range' in headers
+                        or not is_compressible(headers.get('content-type', ''))):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start = message
+                return
+            if passthrough or message['type'] != 'http.response.body':
+                await send(message)
+                return
+            chunks.append(message.get('body', b''))
+            if message.get('more_body', False):
+                return
+            body = b''.join(chunks)
+            headers = MutableHeaders(raw=start['headers'])
+            if len(body) >= self.minimum_size:
+                with phase('compress'):
+                    body = compress(body, encoding, best=False)
+                headers['Content-Encoding'] = encoding
+                headers['Content-Length'] = str(len(body))
+                headers.add_vary_header('Accept-Encoding')
+                if 'etag' in headers and not headers['etag'].startswith('W/'):
+                    headers['ETag'] = f"{headers['etag'][:-1]}-{encoding}\""
+            await send(start)
+            await send({'type': 'http.response.body', 'body': body})
+
+        await self.app(scope, receive, send_compressed)
+
+def precompress(root='static', skip=('photos',)):
+    """Write .gz (and .br) next to every compressible file under root that benefits"""
+    written = 0
+    for directory, dirs, files in os.walk(root):
+        if os.path.relpath(directory, root) == '.':
+            dirs[:] = [d for d in dirs if d not in skip]
+        for filename in files:
+            if not filename.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(directory, filename)
+            with open(path, 'rb') as f:
+                body = f.read()
+            if len(body) < MINIMUM_SIZE:
+                continue
+            for encoding, extension in ENCODINGS:
+                compressed = compress(body, encoding)
+                if len(compressed) < len(body):
+                    with open(path + extension, 'wb') as f:
+                        f.write(compressed)
+                    written += 1
+    print(f"Wrote {written} precompressed files under {root}/")
+
+if __name__ == '__main__':
+    precompress()
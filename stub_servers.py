@@ -0,0 +1,219 @@
+"""Local stand-ins for the external APIs used by process_images.py.
+
+They return canned but well-formed responses so ingest can be exercised
+end-to-end without API keys, network access or cost. For example:
+
+    uvicorn stub_servers:anthropic_app --port 8100
+    uvicorn stub_servers:nominatim_app --port 8101
+    uvicorn stub_servers:serpapi_app --port 8102
+    ANTHROPIC_BASE_URL=http://localhost:8100 NOMINATIM_URL=http://localhost:8101 \
+        SERPAPI_URL=http://localhost:8102 python process_images.py --batch
+
+STUB_BATCH_SECONDS controls how long a fake message batch stays in progress,
+and STUB_LATENCY_MS adds a delay to every response to mimic the real services.
+Token usage is estimated from the request, including prompt caching: the
+first request with a given cache_control prefix writes it, later ones read it.
+"""
+import asyncio
+import io
+import json
+import math
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, Response
+from PIL import Image, ImageDraw
+
+anthropic_app = FastAPI()
+nominatim_app = FastAPI()
+serpapi_app = FastAPI()
+
+# Places the stub geocoder answers with: the nearest one wins
+PLACES = (
+    ('Tokyo', 'Tokyo', 35.6762, 139.6503),
+    ('Osaka', 'Osaka Prefecture', 34.6937, 135.5023),
+    ('Kyoto', 'Kyoto Prefecture', 35.0116, 135.7681),
+    ('Nara', 'Nara Prefecture', 34.6851, 135.8048),
+    ('Hakone', 'Kanagawa Prefecture', 35.2324, 139.1069),
+    ('Austin', 'Texas', 30.2672, -97.7431),
+)
+
+async def _latency():
+    delay = float(os.environ.get('STUB_LATENCY_MS', 0))
+    if delay:
+        await asyncio.sleep(delay / 1000)
+
+def nearest_place(lat, lon):
+    return min(PLACES, key=lambda place: math.hypot(place[2] - lat, place[3] - lon))
+
+BATCHES = {}
+
+# Prompt prefixes that have been "written to the cache"
+CACHED_PREFIXES = set()
+
+# Like the API, shorter prefixes aren't cached and are billed as plain input
+MIN_CACHE_TOKENS = 1024
+
+def _timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+def _tokens(value):
+    return len(json.dumps(value)) // 4
+
+def fake_usage(params, images):
+    """Roughly what the API would bill for params, splitting cached prefix tokens the way it does"""
+    system = params.get('system') or []
+    if isinstance(system, str):
+        system = [{'type': 'text', 'text': system}]
+    # The cache prefix runs tools -> system, up to the last block marked cache_control
+    marked = [index for index, block in enumerate(system) if block.get('cache_control')]
+    prefix = [params.get('tools') or [], system[:marked[-1] + 1]] if marked else None
+    rest = system[marked[-1] + 1:] if marked else [params.get('tools') or [], system]
+    usage = {
+        'input_tokens': 1500 * max(images, 1) + _tokens(rest),
+        'output_tokens': 80,
+        'cache_creation_input_tokens': 0,
+        'cache_read_input_tokens': 0,
+    }
+    if prefix is not None and _tokens(prefix) < MIN_CACHE_TOKENS:
+        usage['input_tokens'] += _tokens(prefix)
+    elif prefix is not None:
+        key = json.dumps(prefix, sort_keys=True)
+        kind = 'cache_read_input_tokens' if key in CACHED_PREFIXES else 'cache_creation_input_tokens'
+        CACHED_PREFIXES.add(key)
+        usage[kind] = _tokens(prefix)
+    return usage
+
+def fake_message(params):
+    """A Messages API response that answers with the requested tool, or plain text"""
+    images = sum(
+        1 for message in params.get('messages', [])
+        if isinstance(message.get('content'), list)
+        for block in message['content'] if block.get('type') == 'image'
+    )
+    tools = params.get('tools') or []
+    analysis = {
+        'caption': f"stub caption from {images} image(s)",
+        'points_of_interest': [{'name': 'Senso-ji', 'description': "tokyo's oldest temple"}],
+    }
+    if tools:
+        content = [{'type': 'tool_use', 'id': f"toolu_{uuid.uuid4().hex[:24]}",
+                    'name': tools[0]['name'], 'input': analysis}]
+        stop_reason = 'tool_use'
+    else:
+        content = [{'type': 'text', 'text': json.dumps(analysis)}]
+        stop_reason = 'end_turn'
+    return {
+        'id': f"msg_{uuid.uuid4().hex[:24]}",
+        'type': 'message',
+        'role': 'assistant',
+        'model': params.get('model', 'stub'),
+        'content': content,
+        'stop_reason': stop_reason,
+        'stop_sequence': None,
+        'usage': fake_usage(params, images),
+    }
+
+def _batch_body(batch, request):
+    duration = float(os.environ.get('STUB_BATCH_SECONDS', 5))
+    ended = time.time() - batch['created'] >= duration
+    total = len(batch['requests'])
+    body = {
+        'id': batch['id'],
+        'type': 'message_batch',
+        'processing_status': 'ended' if ended else 'in_progress',
+        'request_counts': {
+            'processing': 0 if ended else total,
+            'succeeded': total if ended else 0,
+            'errored': 0,
+            'canceled': 0,
+            'expired': 0,
+        },
+        'created_at': _timestamp(batch['created']),
+        'expires_at': (datetime.fromtimestamp(batch['created'], timezone.utc) + timedelta(hours=24)).isoformat(),
+        'ended_at': _timestamp(batch['created'] + duration) if ended else None,
+        'archived_at': None,
+        'cancel_initiated_at': None,
+        'results_url': None,
+    }
+    if ended:
+        body['results_url'] = str(request.base_url).rstrip('/') + f"/v1/messages/batches/{batch['id']}/results"
+    return body
+
+@anthropic_app.post('/v1/messages')
+async def create_message(request: Request):
+    await _latency()
+    return fake_message(await request.json())
+
+@anthropic_app.post('/v1/messages/count_tokens')
+async def count_tokens(request: Request):
+    params = await request.json()
+    prefix = [params.get('tools') or [], params.get('system') or []]
+    tokens = _tokens(prefix) if any(prefix) else 0
+    return {'input_tokens': tokens + _tokens(params.get('messages', []))}
+
+@anthropic_app.post('/v1/messages/batches')
+async def create_batch(request: Request):
+    params = await request.json()
+    batch = {'id': f"msgbatch_{uuid.uuid4().hex[:24]}", 'created': time.time(), 'requests': params['requests']}
+    BATCHES[batch['id']] = batch
+    return _batch_body(batch, request)
+
+@anthropic_app.get('/v1/messages/batches/{batch_id}')
+async def retrieve_batch(batch_id: str, request: Request):
+    if batch_id not in BATCHES:
+        raise HTTPException(status_code=404, detail="batch not found")
+    return _batch_body(BATCHES[batch_id], request)
+
+@anthropic_app.get('/v1/messages/batches/{batch_id}/results')
+async def batch_results(batch_id: str):
+    if batch_id not in BATCHES:
+        raise HTTPException(status_code=404, detail="batch not found")
+    lines = [
+        json.dumps({
+            'custom_id': item['custom_id'],
+            'result': {'type': 'succeeded', 'message': fake_message(item['params'])},
+        })
+        for item in BATCHES[batch_id]['requests']
+    ]
+    return PlainTextResponse('\n'.join(lines) + '\n', media_type='application/binary')
+
+@nominatim_app.get('/reverse')
+async def reverse(lat: float, lon: float):
+    await _latency()
+    city, state, _, _ = nearest_place(lat, lon)
+    return {
+        'lat': str(lat),
+        'lon': str(lon),
+        'display_name': f"{city}, {state}",
+        'address': {'city': city, 'state': state, 'country': 'stub'},
+    }
+
+_map_image = None
+
+@serpapi_app.get('/search')
+async def search(request: Request, q: str = ''):
+    await _latency()
+    return {
+        'search_metadata': {'status': 'Success'},
+        'search_parameters': {'q': q},
+        'local_map': {'image': str(request.base_url).rstrip('/') + '/map.jpg'},
+    }
+
+@serpapi_app.get('/map.jpg')
+async def map_image():
+    """A 600x300 JPEG, about the size of a real local_map screenshot"""
+    global _map_image
+    if _map_image is None:
+        image = Image.new('RGB', (600, 300), (232, 228, 218))
+        draw = ImageDraw.Draw(image)
+        for x in range(0, 600, 40):
+            draw.line([(x, 0), (x + 120, 300)], fill=(255, 255, 255), width=6)
+        draw.ellipse([290, 140, 310, 160], fill=(200, 30, 30))
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=85)
+        _map_image = buffer.getvalue()
+    await _latency()
+    return Response(_map_image, media_type='image/jpeg')